@@ -0,0 +1,393 @@
+import argparse
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+# 压力测试：启动本地模拟节点并上传到节点池，按设定的并发请求 /random 与 allow_urls 重定向接口，输出JSON格式的测试报告
+# --peers 大于1时启动多个互相同步的实例，额外检查节点池同步、封禁同步、健康检测分配与实例下线后的接管，检查失败时退出码为1
+# 模拟节点使用同一个域名的不同端口，该域名需要解析到 127.0.0.1（例如在 /etc/hosts 中添加 127.0.0.1 bench.fqweb.test）
+
+FQWEB_TOKEN = 'benchmark'
+
+
+# 模拟的番茄Web节点：按设定的耗时与错误率响应，item_id=1 以及按 missing_rate 抽中的章节返回“该书不存在”
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stub = self.server.stub
+        path = urlparse(self.path)
+        query = parse_qs(path.query)
+        stub.record(path.path == '/content' and query.get('item_id', ['1']) == ['1'], self.client_address[1])
+        time.sleep(stub.latency)
+        if random.random() < stub.error_rate:
+            body, status = b'error', 500
+        elif query.get('item_id') == ['1'] or random.random() < stub.missing_rate:
+            body, status = '该书不存在'.encode('utf-8'), 200
+        else:
+            body, status = json.dumps({'code': 0, 'path': path.path, 'stub': stub.port}).encode('utf-8'), 200
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Stub:
+    def __init__(self, port, latency, error_rate, missing_rate):
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.missing_rate = missing_rate
+        self.lock = threading.Lock()
+        self.served = 0
+        self.probes = 0
+        self.first_probe = None
+        self.last_probe = None
+        # 设置为服务端进程号列表后，按连接记录每次健康检测来自哪个进程：[(检测时间, 进程号)]
+        self.pids = None
+        self.probe_owners = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    # 不带 item_id 或 item_id=1 的 /content 请求是服务端的健康检测
+    def record(self, probe, client_port):
+        owner = socket_owner(client_port, self.pids) if probe and self.pids else None
+        with self.lock:
+            if probe:
+                self.probes += 1
+                self.last_probe = time.time()
+                if self.first_probe is None:
+                    self.first_probe = self.last_probe
+                if owner is not None:
+                    self.probe_owners.append((self.last_probe, owner))
+            else:
+                self.served += 1
+
+
+# 查找本机TCP连接（按客户端端口）属于哪个进程：/proc/net/tcp 中该连接的 inode 出现在哪个进程的文件描述符中，仅支持Linux
+def socket_owner(port, pids):
+    inodes = set()
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(path) as file:
+                next(file)
+                for line in file:
+                    fields = line.split()
+                    if int(fields[1].rsplit(':', 1)[1], 16) == port:
+                        inodes.add(f'socket:[{fields[9]}]')
+        except OSError:
+            pass
+    for pid in pids:
+        try:
+            fds = os.listdir(f'/proc/{pid}/fd')
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                if os.readlink(f'/proc/{pid}/fd/{fd}') in inodes:
+                    return pid
+            except OSError:
+                pass
+    return None
+
+
+def percentiles(samples, quantiles=(0.5, 0.9, 0.99)):
+    samples = sorted(samples)
+    if not samples:
+        return {f'p{int(q * 100)}': None for q in quantiles}
+    result = {f'p{int(q * 100)}': round(samples[min(int(len(samples) * q), len(samples) - 1)] * 1000, 2)
+              for q in quantiles}
+    result['mean'] = round(statistics.mean(samples) * 1000, 2)
+    result['max'] = round(samples[-1] * 1000, 2)
+    return result
+
+
+def distribution(counts):
+    values = list(counts.values())
+    if not values:
+        return {}
+    return {'nodes': len(values), 'min': min(values), 'max': max(values),
+            'mean': round(statistics.mean(values), 2), 'stdev': round(statistics.pstdev(values), 2)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def start_server(port, peers=()):
+    work_dir = tempfile.mkdtemp(prefix='fqweb-bench-')
+    env = dict(os.environ, FQWEB_PORT=str(port), FQWEB_TOKEN=FQWEB_TOKEN)
+    if peers:
+        env.update(FQWEB_PEERS=','.join(peers), FQWEB_SELF_URL=f'http://127.0.0.1:{port}')
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    process = subprocess.Popen([sys.executable, server], cwd=work_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process
+
+
+def wait_ready(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f'{base_url}/stats', timeout=1).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+# 节点池中的节点数，/available 读取的是当前快照，不依赖维护线程的统计周期
+def available_nodes(base_url):
+    return int(requests.get(f'{base_url}/available', timeout=10).text)
+
+
+def check_text(base_url, domain):
+    return requests.get(f'{base_url}/check', params={'domain': domain}, timeout=10).text
+
+
+# 多实例检查：封禁的同步耗时、健康检测是否按节点分配给各实例（每个节点只由一个实例检测、每个实例都分到节点），
+# 以及停止最后一个实例后其余实例是否继续检测所有节点
+def check_peers(urls, processes, stubs, args):
+    result = {'instances': len(urls)}
+    pids = [process.pid for process in processes]
+    # 上传检测由收到上传的实例执行，从这之后的定期检测开始按进程统计
+    window = time.time()
+    for stub in stubs:
+        stub.pids = pids
+    blocked = stubs[0]
+    domain = f'{args.host}:{blocked.port}'
+    start = time.time()
+    requests.get(f'{urls[0]}/block', params={'token': FQWEB_TOKEN, 'domain': domain}, timeout=10)
+    deadline = time.time() + args.sweep_timeout
+    pending = urls[1:]
+    while time.time() < deadline and pending:
+        pending = [url for url in pending if '封禁' not in check_text(url, domain)]
+        if pending:
+            time.sleep(0.1)
+    result['block_propagation_s'] = None if pending else round(time.time() - start, 3)
+
+    # 等待其余节点都完成至少一次定期检测（第一次在检测通过 min_check_interval 秒后）
+    online = stubs[1:]
+    deadline = time.time() + args.sweep_timeout
+    while time.time() < deadline and any(not owners_since(stub, window) for stub in online):
+        time.sleep(0.5)
+    owners = [owners_since(stub, window) for stub in online]
+    result['nodes_by_instance'] = [sum(1 for stub_owners in owners if stub_owners == {pid}) for pid in pids]
+    result['nodes_probed_by_several'] = sum(1 for stub_owners in owners if len(stub_owners) > 1)
+    result['nodes_unprobed'] = sum(1 for stub_owners in owners if not stub_owners)
+    probes_split = (all(result['nodes_by_instance']) and not result['nodes_probed_by_several']
+                    and not result['nodes_unprobed'])
+
+    processes[-1].terminate()
+    processes[-1].wait()
+    stopped = time.time()
+    deadline = stopped + args.sweep_timeout
+    remaining = stubs[1:]
+    while time.time() < deadline and remaining:
+        remaining = [stub for stub in remaining if not stub.last_probe or stub.last_probe <= stopped]
+        if remaining:
+            time.sleep(0.5)
+    result['takeover_s'] = None if remaining else round(time.time() - stopped, 3)
+    result['ok'] = result['block_propagation_s'] is not None and probes_split and result['takeover_s'] is not None
+    return result
+
+
+def owners_since(stub, since):
+    with stub.lock:
+        return {pid for when, pid in stub.probe_owners if when > since}
+
+
+def parse_mix(mix):
+    paths = []
+    weights = []
+    for item in mix.split(','):
+        path, _, weight = item.partition('=')
+        paths.append(path.strip())
+        weights.append(float(weight or 1))
+    return paths, weights
+
+
+def build_request(path, books):
+    # 书籍热度近似长尾分布
+    book_id = int(random.paretovariate(1.2)) % books + 1
+    if path == 'random':
+        return '/random', {}
+    if path == 'content':
+        return '/content', {'book_id': book_id, 'item_id': book_id * 1000 + random.randint(2, 200)}
+    return f'/{path}', {'book_id': book_id}
+
+
+def run_load(base_url, args):
+    paths, weights = parse_mix(args.mix)
+    local = threading.local()
+    lock = threading.Lock()
+    latencies = {path: [] for path in paths}
+    statuses = {}
+    targets = {}
+    errors = [0]
+
+    def one(_):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        path = random.choices(paths, weights)[0]
+        url, params = build_request(path, args.books)
+        start = time.perf_counter()
+        try:
+            response = session.get(base_url + url, params=params, allow_redirects=False, timeout=args.timeout)
+            body = response.text
+        except requests.RequestException:
+            with lock:
+                errors[0] += 1
+            return
+        elapsed = time.perf_counter() - start
+        # 模拟用完节点后主动释放租约
+        lease_id = response.headers.get('X-Lease-Id')
+        if args.release and lease_id:
+            try:
+                session.get(f'{base_url}/release', params={'lease': lease_id}, timeout=args.timeout)
+            except requests.RequestException:
+                pass
+        target = response.headers.get('Location') or (body if path == 'random' and response.status_code == 200
+                                                      else None)
+        with lock:
+            latencies[path].append(elapsed)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            if target:
+                node = urlparse(target).netloc
+                targets[node] = targets.get(node, 0) + 1
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one, range(args.requests)))
+    duration = time.time() - start
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'duration_s': round(duration, 3),
+        'requests': args.requests,
+        'throughput_rps': round(len(all_latencies) / duration, 2) if duration else None,
+        'errors': errors[0],
+        'status': {str(code): count for code, count in sorted(statuses.items())},
+        'latency_ms': percentiles(all_latencies),
+        'paths': {path: dict(count=len(values), **percentiles(values)) for path, values in latencies.items()},
+        'redirect_targets': distribution(targets),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FQWeb-Server 压力测试')
+    parser.add_argument('--nodes', type=int, default=50, help='模拟节点数量')
+    parser.add_argument('--latency', type=float, default=0.02, help='模拟节点的响应耗时（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟节点返回500的概率')
+    parser.add_argument('--missing-rate', type=float, default=0.0, help='模拟节点返回“该书不存在”的概率')
+    parser.add_argument('--host', default='bench.fqweb.test', help='模拟节点使用的域名，需要解析到127.0.0.1')
+    parser.add_argument('--stub-port', type=int, default=21000, help='模拟节点的起始端口')
+    parser.add_argument('--port', type=int, default=19998, help='启动服务使用的端口')
+    parser.add_argument('--peers', type=int, default=1, help='启动的实例数量，大于1时各实例互相同步（端口从--port开始递增）')
+    parser.add_argument('--server-url', help='测试已经运行的服务（需要使用相同的FQWEB_TOKEN），不再启动新服务')
+    parser.add_argument('--requests', type=int, default=5000, help='总请求数')
+    parser.add_argument('--concurrency', type=int, default=32, help='并发数')
+    parser.add_argument('--mix', default='random=1,content=4,catalog=1,info=1', help='请求接口及其权重')
+    parser.add_argument('--books', type=int, default=1000, help='书籍数量')
+    parser.add_argument('--release', action='store_true', help='请求完成后通过 /release 释放租约')
+    parser.add_argument('--timeout', type=float, default=30, help='单个请求的超时时间（秒）')
+    parser.add_argument('--sweep-timeout', type=float, default=60, help='等待所有节点完成首次健康检测并加入节点池的最长时间（秒）')
+    parser.add_argument('--output', help='报告输出文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    try:
+        socket.gethostbyname(args.host)
+    except OSError:
+        sys.exit(f'域名{args.host}无法解析，请在 /etc/hosts 中添加：127.0.0.1 {args.host}')
+
+    stubs = [Stub(args.stub_port + i, args.latency, args.error_rate, args.missing_rate) for i in range(args.nodes)]
+    processes = []
+    if args.server_url:
+        urls = [args.server_url.rstrip('/')]
+    else:
+        urls = [f'http://127.0.0.1:{args.port + i}' for i in range(max(args.peers, 1))]
+        processes = [start_server(args.port + i, urls if len(urls) > 1 else ()) for i in range(len(urls))]
+    base_url = urls[0]
+    try:
+        if not all(wait_ready(url) for url in urls):
+            sys.exit('服务启动失败')
+
+        # 上传节点（多实例时轮流上传到各实例），记录所有节点完成首次健康检测的耗时
+        upload_start = time.time()
+        for i, stub in enumerate(stubs):
+            requests.get(f'{urls[i % len(urls)]}/upload', params={'domain': f'{args.host}:{stub.port}'}, timeout=10)
+        upload_time = time.time() - upload_start
+        deadline = time.time() + args.sweep_timeout
+        while time.time() < deadline and any(stub.first_probe is None for stub in stubs):
+            time.sleep(0.1)
+        probed = [stub.first_probe - upload_start for stub in stubs if stub.first_probe is not None]
+        # 上传的节点检测通过后才加入节点池，多实例时等待所有实例都同步到该节点
+        pending = [(stub, url) for stub in stubs if stub.first_probe is not None for url in urls]
+        while time.time() < deadline and pending:
+            pending = [(stub, url) for stub, url in pending if '在线' not in check_text(url, f'{args.host}:{stub.port}')]
+            if pending:
+                time.sleep(0.1)
+        verified_time = time.time() - upload_start
+
+        active_nodes = available_nodes(base_url)
+        load = run_load(base_url, args)
+        report = {
+            'commit': git_commit(),
+            'config': {key: value for key, value in vars(args).items() if key != 'output'},
+            'upload_s': round(upload_time, 3),
+            'health': {
+                'first_sweep_s': round(max(probed), 3) if len(probed) == len(stubs) else None,
+                'verified_s': round(verified_time, 3) if not pending else None,
+                'probed_nodes': len(probed),
+                'probes': sum(stub.probes for stub in stubs),
+            },
+            'load': load,
+            'active_nodes': active_nodes,
+        }
+        # 重定向模式下客户端不跟随重定向，模拟节点不会收到请求，只有代理模式才统计各节点承担的请求数
+        if any(stub.served for stub in stubs):
+            report['served_by_nodes'] = distribution({stub.port: stub.served for stub in stubs})
+        if len(urls) > 1:
+            report['peers'] = check_peers(urls, processes, stubs, args)
+            report['peers']['ok'] = report['peers']['ok'] and not pending
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if not report.get('peers', {}).get('ok', True):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
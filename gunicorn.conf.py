@@ -0,0 +1,23 @@
+# 多进程部署：gunicorn -c gunicorn.conf.py server:app
+# 各 worker 通过 data/shared.bin 共享节点载荷、检测结果与请求计数，只有一个 worker 负责健康检测
+import os
+
+os.environ.setdefault('FQWEB_SHARED', '1')
+
+bind = os.environ.get('FQWEB_BIND', '0.0.0.0:9998')
+workers = int(os.environ.get('FQWEB_WORKERS', 4))
+worker_class = 'gthread'
+threads = int(os.environ.get('FQWEB_THREADS', 32))
+
+
+def on_starting(server):
+    # 上次运行残留的载荷已经无效，启动时重建共享表（请求计数会从 statistics.json 恢复）
+    shared_path = os.path.join('data', 'shared.bin')
+    if os.path.exists(shared_path):
+        os.remove(shared_path)
+
+
+def post_worker_init(worker):
+    # 导入 server 模块时不加载数据，worker 启动后再加载快照并启动后台任务
+    from server import startup
+    startup()
@@ -1,15 +1,37 @@
+import array
+import atexit
+import bisect
+import collections
+import contextlib
 import datetime
+import hashlib
+import heapq
+import itertools
+import mmap
 import os
+import random
 import re
+import struct
 import subprocess
 import sys
 import threading
 import time
 import json
+import math
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 下没有 fcntl，不支持多进程共享模式
+    fcntl = None
 
 import requests
+from requests.adapters import HTTPAdapter
 import schedule
-from flask import Flask, request, redirect
+from flask import Flask, request, redirect, Response, g, has_request_context
 
 app = Flask(__name__)
 
@@ -19,7 +41,8 @@ VERSION_CODE = 112
 # 获取最新的commit_id
 def get_latest_commit_id():
     try:
-        commit_id = '-' + subprocess.check_output('git rev-parse --short HEAD', shell=True).decode().strip()
+        commit_id = '-' + subprocess.check_output('git rev-parse --short HEAD', shell=True,
+                                                  stderr=subprocess.DEVNULL).decode().strip()
         return commit_id
     except Exception:
         return ""
@@ -27,9 +50,7 @@ def get_latest_commit_id():
 
 COMMIT_ID = ""
 
-if not COMMIT_ID:
-    COMMIT_ID = get_latest_commit_id()
-
+# commit_id 在启动后由后台线程查询（load_version_name），导入模块时不执行git命令
 VERSION_NAME = "v" + ".".join(str(VERSION_CODE)) + COMMIT_ID
 
 # 管理员TOKEN
@@ -39,12 +60,6 @@ FQWEB_TOKEN = os.environ.get("FQWEB_TOKEN")
 data_dir = "data"
 os.makedirs(data_dir, exist_ok=True)
 
-# Node pool and recycle bin to store domain names
-node_pool = []
-recycle_bin = []
-tokens = []
-block_domains = []
-
 # 统计数据变量
 total_requests = 0
 daily_requests = 0
@@ -52,13 +67,104 @@ yesterday_requests = 0
 shared_nodes = 0
 active_nodes = 0
 start_time = time.time()
+# 本次进程的启动时间（start_time 会从统计数据中恢复为首次运行的时间）
+process_start = time.time()
 
 # 节点的最大载荷数
 max_load_per_node = 4
 process_time = 5
+# 重定向与 /random 分配节点时发放租约，客户端或节点用完后通过 /release 释放，未释放的租约 lease_ttl 秒后过期
+lease_ttl = float(os.environ.get("FQWEB_LEASE_TTL", process_time))
 max_remove_time = 60 * 30
+# 变更日志累计多少条或距离上次快照多少秒后重新生成快照
+compact_entries = 1000
+compact_interval = 5 * 60
+# 节点选取策略：p2c 随机取两个节点按预计耗时择优，least_load 选载荷最低的节点，
+# affinity 按 book_id/item_id 在一致性哈希环上选取节点（请求没有这两个参数时按 p2c 选取）
+selection_policy = os.environ.get("FQWEB_SELECTION_POLICY", "p2c")
+# 一致性哈希环上每个节点的虚拟节点数
+ring_replicas = 64
+# 检测耗时与成功率的EWMA平滑系数、未检测过的节点的默认耗时（秒）以及失败惩罚系数
+ewma_alpha = 0.3
+default_rtt = 1.0
+failure_penalty = 4
+# 节点全部满载时的最大排队请求数与单个请求的最长等待时间（秒）
+max_wait_queue = 256
+max_wait_time = 10
 allow_urls = ['search', 'info', 'catalog', 'content', 'reading/bookapi/bookmall/cell/change/v1/',
               'reading/bookapi/new_category/landing/v/']
+# 代理模式：allow_urls 的请求由服务端通过与节点保持的长连接转发，而不是302重定向，响应结束即释放载荷
+proxy_mode = os.environ.get("FQWEB_PROXY") == "1"
+proxy_timeout = 30
+proxy_chunk_size = 64 * 1024
+# 转发时透传的响应头，其余逐跳头由服务器重新生成
+proxy_headers = ['Content-Type', 'Content-Encoding', 'Content-Length', 'Cache-Control', 'Last-Modified', 'ETag']
+# 代理模式的响应缓存：总大小上限（字节，0为关闭）、单个响应的大小上限以及各接口的缓存时间（秒）
+cache_max_bytes = int(os.environ.get("FQWEB_CACHE_BYTES", 64 * 1024 * 1024))
+cache_max_entry_bytes = 1024 * 1024
+cache_ttls = {'content': 24 * 60 * 60, 'info': 10 * 60, 'catalog': 10 * 60,
+              'reading/bookapi/bookmall/cell/change/v1/': 60, 'reading/bookapi/new_category/landing/v/': 60}
+# 相同请求合并时等待首个请求结果的最长时间（秒），超时后自行请求节点
+coalesce_timeout = 5
+# /status 与 /stats 的响应体按节点池快照版本缓存，节点载荷与请求计数随时变化，缓存最多使用 body_cache_ttl 秒
+body_cache_ttl = 1
+# 批量接口单次最多处理的条目数，以及 /status、/get/blocks 流式输出时每次写出的行数
+max_batch_items = 1000
+stream_chunk_lines = 500
+
+# 多进程共享模式（gunicorn 多 worker 部署，见 gunicorn.conf.py）：节点载荷、检测结果与请求计数保存在共享内存文件中，
+# 节点池变更通过变更日志同步，只有一个 worker 负责健康检测
+shared_mode = os.environ.get("FQWEB_SHARED") == "1"
+shared_slots = 16384
+shared_sync_interval = 0.5
+# 共享表最多登记的进程数；进程退出或超过 shared_process_timeout 秒没有心跳时，由负责健康检测的进程回收其占用的载荷
+shared_processes = 64
+shared_process_timeout = 60
+
+# 健康检测的最大并发数与单次检测超时时间
+check_concurrency = int(os.environ.get("FQWEB_CHECK_CONCURRENCY", 32))
+check_timeout = 10
+# 每秒最多发起的检测次数
+probe_budget = int(os.environ.get("FQWEB_PROBE_BUDGET", 50))
+# 节点检测间隔：连续成功 stable_probes 次后每次翻倍直到上限，失败或恢复后回到最短间隔
+min_check_interval = 10
+max_check_interval = 60
+stable_probes = 3
+strict_check_interval = 10 * 60
+# 最近一个维护周期的检测统计
+last_sweep = {'checked': 0, 'failed': 0, 'lag': 0, 'pending': 0}
+
+# 上传的节点先进入待检测队列，基础检测与严格检测都通过后才加入节点池
+max_pending_uploads = 1024
+upload_verify_concurrency = 8
+upload_result_history = 4096
+# 共享模式下检测状态通过变更日志同步到其他 worker，其他 worker 检测中的域名超过该时间（秒）没有结果时视为检测中断
+upload_pending_timeout = 3 * 60
+
+# 重启时只有最近 warm_restart_window 秒内检测通过且成功率不低于 warm_min_success 的节点直接提供服务，
+# 其余节点先放入回收站，由后台并发检测通过后再恢复
+warm_restart_window = 10 * 60
+warm_min_success = 0.5
+
+# 多实例同步：FQWEB_PEERS 为其他实例的地址（逗号分隔），FQWEB_SELF_URL 为其他实例访问本实例的地址
+# 各实例定期向其他实例拉取节点池、token与黑名单的增量，健康检测按域名哈希分配给在线的实例
+peer_urls = [url.strip().rstrip('/') for url in os.environ.get("FQWEB_PEERS", "").split(',') if url.strip()]
+self_url = os.environ.get("FQWEB_SELF_URL", f"http://127.0.0.1:{os.environ.get('FQWEB_PORT', 9998)}").rstrip('/')
+peer_sync_interval = 2
+peer_timeout = 10
+
+# 历史统计：每10秒采样一次，按分钟与小时汇总，各保留7天
+history_sample_interval = 10
+history_minutes = 7 * 24 * 60
+history_hours = 7 * 24
+history_save_interval = 5 * 60
+# 共享模式下只有负责健康检测的 worker 采样，保存间隔缩短为1分钟，其他 worker 查询时重新加载保存的文件
+history_shared_save_interval = 60
+
+# 调试：是否记录请求的耗时分段（可通过 /debug/trace 开关）、保留的请求数以及采样分析的最长时间（秒）
+trace_requests = os.environ.get("FQWEB_TRACE") == "1"
+trace_history = 1000
+max_profile_seconds = 10 * 60
 
 
 # 日志打印
@@ -68,19 +174,1956 @@ def log(msg):
     print(f"[{china_time.strftime('%Y.%m.%d %H:%M:%S')}] {msg}")
 
 
+# 按载荷分桶的节点索引：桶内用数组+下标实现O(1)增删与随机选取，载荷每次只变化1，最低载荷指针摊还O(1)
+class LoadBuckets:
+    def __init__(self):
+        # 载荷 -> [域名]
+        self.buckets = {}
+        # 域名 -> (载荷, 在桶中的下标)
+        self.position = {}
+        self.min_load = 0
+        self.total_load = 0
+
+    def __len__(self):
+        return len(self.position)
+
+    def add(self, domain, load):
+        if domain in self.position:
+            self.remove(domain)
+        bucket = self.buckets.setdefault(load, [])
+        self.position[domain] = (load, len(bucket))
+        bucket.append(domain)
+        if len(self.position) == 1 or load < self.min_load:
+            self.min_load = load
+        self.total_load += load
+
+    def remove(self, domain):
+        if domain not in self.position:
+            return
+        load, index = self.position.pop(domain)
+        bucket = self.buckets[load]
+        # 用桶内最后一个元素填补空位
+        last = bucket.pop()
+        if last != domain:
+            bucket[index] = last
+            self.position[last] = (load, index)
+        if not bucket:
+            del self.buckets[load]
+        self.total_load -= load
+
+    def update(self, domain, load):
+        if domain in self.position:
+            self.add(domain, load)
+
+    # 返回载荷最低的节点，载荷相同时随机选取；没有节点时返回None
+    def pick(self):
+        if not self.position:
+            return None
+        while self.min_load not in self.buckets:
+            self.min_load += 1
+        return self.min_load, random.choice(self.buckets[self.min_load])
+
+
+# 一致性哈希环：每个节点映射为 replicas 个虚拟节点，节点加入或离开时只有相邻区间的键（约1/n）改变归属
+class HashRing:
+    def __init__(self, replicas=64):
+        self.replicas = replicas
+        # 已排序的虚拟节点哈希值，以及哈希值 -> 域名
+        self.hashes = []
+        self.owners = {}
+
+    def __len__(self):
+        return len(self.hashes) // self.replicas
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def add(self, domain):
+        for i in range(self.replicas):
+            point = self.hash(f'{domain}#{i}')
+            if point not in self.owners:
+                bisect.insort(self.hashes, point)
+                self.owners[point] = domain
+
+    def remove(self, domain):
+        for i in range(self.replicas):
+            point = self.hash(f'{domain}#{i}')
+            if self.owners.get(point) == domain:
+                del self.owners[point]
+                del self.hashes[bisect.bisect_left(self.hashes, point)]
+
+    # 从键所在位置开始顺时针依次返回不同的节点
+    def walk(self, key):
+        if not self.hashes:
+            return
+        start = bisect.bisect(self.hashes, self.hash(key))
+        seen = set()
+        for i in range(len(self.hashes)):
+            domain = self.owners[self.hashes[(start + i) % len(self.hashes)]]
+            if domain not in seen:
+                seen.add(domain)
+                yield domain
+
+
+# 黑名单：规则按域名标签反转后存入字典树，查找耗时只与域名的标签数有关
+# 规则形式：host:port 只封禁该端口，host 封禁所有端口，*.suffix（或 *.suffix:port）封禁 suffix 的所有子域名
+# 写入在注册表的锁内完成，查找不加锁；规则可以设置过期时间，过期后不再匹配，由维护线程清理
+class BlockList:
+    def __init__(self):
+        # 字典树节点：[子节点 {标签: 节点}, 精确规则 {端口: 规则}, 通配规则 {端口: 规则}]，端口为None表示不限端口
+        self.root = [{}, {}, {}]
+        # 规则 -> (封禁时间, 过期时间)，过期时间为None表示永久
+        self.rules = {}
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __contains__(self, rule):
+        return rule in self.rules
+
+    # 拆分规则为 (反转后的标签, 端口, 是否通配)
+    @staticmethod
+    def parse(rule):
+        host, _, port = rule.lower().partition(':')
+        wildcard = host.startswith('*.')
+        if wildcard:
+            host = host[2:]
+        return host.split('.')[::-1], port or None, wildcard
+
+    def add(self, rule, block_time, expire=None):
+        labels, port, wildcard = self.parse(rule)
+        node = self.root
+        for label in labels:
+            node = node[0].setdefault(label, [{}, {}, {}])
+        node[2 if wildcard else 1][port] = rule
+        self.rules[rule] = (block_time, expire)
+
+    # 删除规则，并删除不再有规则的字典树节点
+    def remove(self, rule):
+        if self.rules.pop(rule, None) is None:
+            return False
+        labels, port, wildcard = self.parse(rule)
+        path = [self.root]
+        for label in labels:
+            path.append(path[-1][0][label])
+        path[-1][2 if wildcard else 1].pop(port, None)
+        for parent, label in zip(reversed(path[:-1]), reversed(labels)):
+            child = parent[0][label]
+            if child[0] or child[1] or child[2]:
+                break
+            del parent[0][label]
+        return True
+
+    def clear(self):
+        self.root = [{}, {}, {}]
+        self.rules = {}
+
+    def _active(self, rule, now):
+        if rule is None:
+            return False
+        entry = self.rules.get(rule)
+        return entry is not None and (entry[1] is None or entry[1] > now)
+
+    # 返回匹配域名（host 或 host:port）的规则，没有匹配时返回None
+    def match(self, domain):
+        host, _, port = domain.lower().partition(':')
+        port = port or None
+        labels = host.split('.')
+        node = self.root
+        now = time.time()
+        for i in range(len(labels) - 1, -1, -1):
+            node = node[0].get(labels[i])
+            if node is None:
+                return None
+            # 还有剩余的标签时，当前节点上的通配规则匹配
+            if i and node[2]:
+                for rule in (node[2].get(port), node[2].get(None)):
+                    if self._active(rule, now):
+                        return rule
+        for rule in (node[1].get(port), node[1].get(None)):
+            if self._active(rule, now):
+                return rule
+        return None
+
+    # 规则是否匹配域名，用于封禁时找出需要移除的节点
+    def rule_matches(self, rule, domain):
+        labels, port, wildcard = self.parse(rule)
+        host, _, domain_port = domain.lower().partition(':')
+        domain_labels = host.split('.')[::-1]
+        if port is not None and port != (domain_port or None):
+            return False
+        if wildcard:
+            return len(domain_labels) > len(labels) and domain_labels[:len(labels)] == labels
+        return domain_labels == labels
+
+    def expired(self, now):
+        return [rule for rule, (_, expire) in list(self.rules.items()) if expire is not None and expire <= now]
+
+    def items(self):
+        blocks = []
+        for rule, (block_time, expire) in self.rules.items():
+            block = {'domain': rule, 'time': block_time}
+            if expire is not None:
+                block['expire'] = expire
+            blocks.append(block)
+        return blocks
+
+
+# 节点池的只读快照：版本号、节点池（域名 -> 节点）、节点池域名数组、token -> 节点（优先节点池，其次回收站）、黑名单
+# 快照发布后不再修改，读取方无需加锁也无需复制；节点对象中的载荷与检测结果、黑名单仍会原地更新
+PoolSnapshot = collections.namedtuple('PoolSnapshot', ['version', 'nodes', 'members', 'tokens', 'blocks'])
+
+
+# 节点注册表：节点池、回收站按域名索引，token与封禁域名也各自建立索引，所有读写都在同一把锁内完成
+# 结构性变更只增加版本号，读取方通过 view() 获取当前版本的快照，同一版本的快照只生成一次
+class NodeRegistry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        # 域名 -> 节点，dict保持插入顺序
+        self.pool = {}
+        self.recycle = {}
+        # token -> {域名: 节点}
+        self.tokens = {}
+        # 封禁规则
+        self.blocks = BlockList()
+        # 节点池中节点的载荷索引
+        self.loads = LoadBuckets()
+        # 节点池中的域名数组及其下标，用于O(1)随机抽样
+        self.members = []
+        self.member_index = {}
+        # 结构性变更写入的变更日志
+        self.journal = None
+        # 多进程共享模式下保存载荷与检测结果的共享表
+        self.shared = None
+        # 内容亲和路由使用的一致性哈希环，只包含节点池中的节点
+        self.ring = None
+        # 结构版本号与最近发布的快照
+        self.version = 0
+        self.snapshot = PoolSnapshot(0, {}, (), {}, {})
+
+    def _record(self, op, **fields):
+        self.version += 1
+        if self.journal:
+            self.journal.record(op, **fields)
+
+    # 返回当前版本的快照，版本变化后第一次读取时在锁内重新生成并替换引用
+    def view(self):
+        snapshot = self.snapshot
+        if snapshot.version == self.version:
+            return snapshot
+        with self.lock:
+            if self.snapshot.version != self.version:
+                tokens = {}
+                for token, nodes in self.tokens.items():
+                    pooled = [node for node in nodes.values() if node['domain'] in self.pool]
+                    tokens[token] = pooled[0] if pooled else next(iter(nodes.values()))
+                self.snapshot = PoolSnapshot(self.version, dict(self.pool), tuple(self.members), tokens,
+                                             self.blocks)
+            return self.snapshot
+
+    def load(self, pool, recycle, blocks):
+        with self.lock:
+            for node in recycle:
+                self._index(node)
+                self.recycle[node['domain']] = node
+            for node in pool:
+                self._unindex(self.recycle.pop(node['domain'], None))
+                self._index(node)
+                self._add_to_pool(node)
+            for block in blocks:
+                self.blocks.add(block['domain'], block['time'], block.get('expire'))
+            self.version += 1
+
+    def _add_to_pool(self, node):
+        node.setdefault('load', 0)
+        self.pool[node['domain']] = node
+        self.loads.add(node['domain'], node['load'])
+        self.member_index[node['domain']] = len(self.members)
+        self.members.append(node['domain'])
+        if self.ring is not None:
+            self.ring.add(node['domain'])
+
+    def _pop_from_pool(self, domain):
+        self.loads.remove(domain)
+        index = self.member_index.pop(domain)
+        last = self.members.pop()
+        if last != domain:
+            self.members[index] = last
+            self.member_index[last] = index
+        if self.ring is not None:
+            self.ring.remove(domain)
+        return self.pool.pop(domain)
+
+    def _index(self, node):
+        if node.get('token'):
+            self.tokens.setdefault(node['token'], {})[node['domain']] = node
+
+    def _unindex(self, node):
+        if not node or not node.get('token'):
+            return
+        nodes = self.tokens.get(node['token'])
+        if nodes and nodes.get(node['domain']) is node:
+            del nodes[node['domain']]
+            if not nodes:
+                del self.tokens[node['token']]
+
+    def pool_count(self):
+        return len(self.pool)
+
+    def recycle_count(self):
+        return len(self.recycle)
+
+    def pool_nodes(self):
+        with self.lock:
+            return list(self.pool.values())
+
+    def recycle_nodes(self):
+        with self.lock:
+            return list(self.recycle.values())
+
+    # 根据token查找节点，include_recycle为True时也查找回收站
+    def find_by_token(self, token, include_recycle=False):
+        with self.lock:
+            for node in self.tokens.get(token, {}).values():
+                if include_recycle or node['domain'] in self.pool:
+                    return node
+            return None
+
+    # 添加节点到节点池（同时从回收站移除），节点池中已存在该域名时返回False
+    def add(self, node):
+        with self.lock:
+            if node['domain'] in self.pool:
+                return False
+            self._unindex(self.recycle.pop(node['domain'], None))
+            self._index(node)
+            self._add_to_pool(node)
+            self._record('add', node=persist_node(node))
+            return True
+
+    # 节点池 -> 回收站，节点已被移除或替换时忽略
+    def move_to_recycle(self, node):
+        with self.lock:
+            if self.pool.get(node['domain']) is not node:
+                return False
+            self._pop_from_pool(node['domain'])
+            self.recycle[node['domain']] = node
+            self._record('recycle', domain=node['domain'], timestamp=node.get('timestamp'))
+            return True
+
+    # 回收站 -> 节点池
+    def restore(self, node):
+        with self.lock:
+            if self.recycle.get(node['domain']) is not node:
+                return False
+            del self.recycle[node['domain']]
+            self._add_to_pool(node)
+            self._record('restore', domain=node['domain'], timestamp=node.get('timestamp'))
+            return True
+
+    # 从节点池和回收站中移除节点，传入节点对象时只移除同一个对象
+    def remove(self, domain, node=None):
+        with self.lock:
+            if domain in self.pool and (node is None or self.pool[domain] is node):
+                removed = self._pop_from_pool(domain)
+            elif domain in self.recycle and (node is None or self.recycle[domain] is node):
+                removed = self.recycle.pop(domain)
+            else:
+                return None
+            self._unindex(removed)
+            # 同步其他进程的变更时不释放，槽位由执行移除的进程释放
+            if self.shared and not (self.journal and self.journal.is_replaying()):
+                self.shared.free(domain)
+            self._record('remove', domain=domain)
+            return removed
+
+    def remove_by_token(self, token):
+        with self.lock:
+            node = self.find_by_token(token, include_recycle=True)
+            if node:
+                return self.remove(node['domain'], node)
+            return None
+
+    # 共享模式下节点池和回收站中的节点使用共享表的槽位，其他节点（如检测中的上传节点）只记录本地载荷
+    def _shared_slot(self, node):
+        if self.shared and node is (self.pool.get(node['domain']) or self.recycle.get(node['domain'])):
+            return self.shared.slot(node['domain'])
+        return None
+
+    # 节点载荷加一，指定 max_load 时载荷已达上限则返回False；节点在节点池中时同步更新载荷索引
+    def acquire(self, node, max_load=None):
+        with self.lock:
+            slot = self._shared_slot(node)
+            if slot is not None:
+                load = self.shared.add_load(slot, 1, max_load)
+                node['load'] = self.shared.load(slot) if load is None else load
+            elif max_load is None or node.get('load', 0) < max_load:
+                load = node['load'] = node.get('load', 0) + 1
+            else:
+                load = None
+            self._sync_load(node)
+            return load is not None
+
+    def release(self, node):
+        with self.lock:
+            slot = self._shared_slot(node)
+            if slot is not None:
+                node['load'] = self.shared.add_load(slot, -1)
+            else:
+                node['load'] = max(node.get('load', 0) - 1, 0)
+            self._sync_load(node)
+
+    # 共享模式下从共享表读取节点的最新载荷与检测结果
+    def _refresh(self, node):
+        if self.shared:
+            slot = self.shared.slot(node['domain'])
+            node['load'] = self.shared.load(slot)
+            rtt, success = self.shared.health(slot)
+            if rtt is not None:
+                node['rtt'] = rtt
+                node['success'] = success
+            self._sync_load(node)
+        return node
+
+    def refresh_shared(self):
+        with self.lock:
+            for node in list(self.pool.values()):
+                self._refresh(node)
+
+    # 检测结果更新后发布到共享表
+    def publish_health(self, node):
+        with self.lock:
+            slot = self._shared_slot(node) if 'rtt' in node else None
+            if slot is not None:
+                self.shared.set_health(slot, node['rtt'], node.get('success', 1.0))
+
+    def _sync_load(self, node):
+        if self.pool.get(node['domain']) is node:
+            self.loads.update(node['domain'], node['load'])
+
+    # 返回载荷最低的节点（载荷相同时随机），节点池为空时返回None
+    def least_loaded(self):
+        with self.lock:
+            picked = self.loads.pick()
+            return self.pool[picked[1]] if picked else None
+
+    # 选取载荷最低且未达到 max_load 的节点并占用一个载荷，全部满载时返回None
+    # 共享模式下本地载荷可能已过期，占用失败时载荷索引会被更新为最新值，继续尝试下一个节点
+    def acquire_least_loaded(self, max_load):
+        with self.lock:
+            while True:
+                picked = self.loads.pick()
+                if not picked or picked[0] >= max_load:
+                    return None
+                node = self.pool[picked[1]]
+                if self.acquire(node, max_load):
+                    return node
+
+    # 随机抽取两个节点，选择 cost 最小且载荷低于 max_load 的一个；两个都满载时退回到载荷最低的节点
+    def two_choices(self, cost, max_load=None):
+        with self.lock:
+            if not self.members:
+                return None
+            candidates = [self._refresh(self.pool[domain])
+                          for domain in random.sample(self.members, min(2, len(self.members)))]
+            if max_load is not None:
+                candidates = [node for node in candidates if node['load'] < max_load]
+            if candidates:
+                return min(candidates, key=cost)
+            picked = self.loads.pick()
+            if picked[0] >= max_load:
+                return None
+            return self.pool[picked[1]]
+
+    def acquire_two_choices(self, cost, max_load):
+        with self.lock:
+            node = self.two_choices(cost, max_load)
+            if node and self.acquire(node, max_load):
+                return node
+            return self.acquire_least_loaded(max_load) if self.shared else None
+
+    # 一致性哈希 + 有界载荷：沿哈希环找到第一个载荷低于 max_load 的节点，相同的键总是落在同一个节点上，
+    # 直到该节点满载才顺延到环上的下一个节点；全部满载时返回键所在的节点
+    def affinity(self, key, max_load):
+        with self.lock:
+            first = None
+            for domain in self.ring.walk(key):
+                node = self._refresh(self.pool[domain])
+                if node['load'] < max_load:
+                    return node
+                first = first or node
+            return first
+
+    def acquire_affinity(self, key, max_load):
+        with self.lock:
+            for domain in self.ring.walk(key):
+                node = self.pool[domain]
+                if self.acquire(node, max_load):
+                    return node
+            return None
+
+    def total_load(self):
+        return self.loads.total_load
+
+    def is_blocked(self, domain):
+        return self.blocks.match(domain) is not None
+
+    # 添加封禁规则，同时将匹配的节点移出节点池和回收站；expire 为规则的过期时间
+    def block(self, rule, block_time=None, expire=None):
+        with self.lock:
+            block_time = block_time or fmt_time(time.time())
+            self.blocks.add(rule, block_time, expire)
+            if expire is None:
+                self._record('block', domain=rule, time=block_time)
+            else:
+                self._record('block', domain=rule, time=block_time, expire=expire)
+            if rule.startswith('*.') or ':' not in rule:
+                for domain in [domain for domain in list(self.pool) + list(self.recycle)
+                               if self.blocks.rule_matches(rule, domain)]:
+                    self.remove(domain)
+            else:
+                self.remove(rule)
+
+    def unblock(self, rule):
+        with self.lock:
+            if self.blocks.remove(rule):
+                self._record('unblock', domain=rule)
+                return True
+            return False
+
+    def clear_blocks(self):
+        with self.lock:
+            self.blocks.clear()
+            self._record('clear_blocks')
+
+    # 清理已过期的封禁规则，返回清理数量
+    def evict_expired_blocks(self):
+        with self.lock:
+            rules = self.blocks.expired(time.time())
+            for rule in rules:
+                self.unblock(rule)
+            return len(rules)
+
+    def blocked(self):
+        with self.lock:
+            return self.blocks.items()
+
+
+registry = NodeRegistry()
+if selection_policy == 'affinity':
+    registry.ring = HashRing(ring_replicas)
+
+
+# token存储：按token索引过期时间，过期时间最小堆用于批量清理过期token
+# 过期时间更新后堆中的旧条目不会立即删除，弹出时与当前过期时间比对后丢弃
+class TokenStore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        # token -> 过期时间
+        self.expires = {}
+        # (过期时间, token)
+        self.heap = []
+        # 新token写入变更日志，已有token的续期只在快照中保存
+        self.journal = None
+
+    def __len__(self):
+        return len(self.expires)
+
+    def load(self, tokens):
+        with self.lock:
+            for token in tokens:
+                self.expires[token['token']] = token['expire_time']
+            self._rebuild()
+
+    def dump(self):
+        with self.lock:
+            return [{'token': token, 'expire_time': expire_time} for token, expire_time in self.expires.items()]
+
+    # 返回token的过期时间，不存在时返回None
+    def get(self, token):
+        return self.expires.get(token)
+
+    def is_valid(self, token):
+        expire_time = self.expires.get(token)
+        return expire_time is not None and expire_time >= time.time()
+
+    # 批量延长token有效期：已过期的从当前时间起算，未过期的在原过期时间上累加
+    # 共享模式或多实例同步时续期也需要同步给其他进程或实例，整批续期记录为一条日志
+    def extend(self, tokens, seconds):
+        now = time.time()
+        with self.lock:
+            updated = {}
+            for token in tokens:
+                expire_time = self.expires.get(token)
+                if self.journal and not self.journal.shared:
+                    if expire_time is None:
+                        self.journal.record('token', token=token, expire_time=now + seconds)
+                    else:
+                        self.journal.touch()
+                if expire_time is None or expire_time < now:
+                    expire_time = now + seconds
+                else:
+                    expire_time += seconds
+                updated[token] = expire_time
+            if updated and self.journal and (self.journal.shared or self.journal.listener):
+                self.journal.record('tokens', expires=updated)
+            self._set(updated)
+
+    # 直接设置过期时间，用于同步其他进程的变更
+    def set_expires(self, expires):
+        with self.lock:
+            self._set(expires)
+
+    def _set(self, expires):
+        for token, expire_time in expires.items():
+            self.expires[token] = expire_time
+            heapq.heappush(self.heap, (expire_time, token))
+        # 旧条目过多时重建堆，保证内存与token数量成正比
+        if len(self.heap) > 2 * len(self.expires) + 64:
+            self._rebuild()
+
+    # 清理所有已过期的token，返回清理数量
+    def evict_expired(self):
+        now = time.time()
+        evicted = 0
+        with self.lock:
+            while self.heap and self.heap[0][0] < now:
+                expire_time, token = heapq.heappop(self.heap)
+                if self.expires.get(token) == expire_time:
+                    del self.expires[token]
+                    evicted += 1
+        return evicted
+
+    def _rebuild(self):
+        self.heap = [(expire_time, token) for token, expire_time in self.expires.items()]
+        heapq.heapify(self.heap)
+
+
+token_store = TokenStore()
+
+
+# 持久化节点时不保存载荷
+def persist_node(node):
+    return {key: value for key, value in node.items() if key != 'load'}
+
+
+# 原子写入JSON文件：先写临时文件再替换，写入中途崩溃不会留下截断的文件
+# 先写入临时文件再替换，临时文件名带上进程号与线程号，多个 worker 同时写同一个文件时互不干扰
+def write_file_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_json_atomic(path, data):
+    write_file_atomic(path, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+
+# 多进程共享表：基于 mmap 的定长文件，保存请求计数、变更日志序号、每个节点的载荷和检测结果，
+# 以及进程表（进程号、心跳时间）、每个进程在每个节点上占用的载荷（进程异常退出后据此归还载荷）和历史统计使用的请求计数
+# 跨进程互斥使用 fcntl 记录锁，按字节范围加锁，不同节点的载荷更新互不阻塞；记录锁不区分同一进程内的线程，再加一把本地锁
+# 加锁顺序：头部 -> 槽位
+class SharedTable:
+    MAGIC = b'FQW2'
+    HEADER = struct.Struct('<4sI4qI')
+    HEADER_SIZE = 64
+    # 槽位状态（0 空闲、1 使用中、2 已释放）、载荷、检测耗时、成功率、域名
+    SLOT = struct.Struct('<Bxxxidd272s')
+    FREE, USED, DELETED = range(3)
+    # 进程号（0 为空闲）、心跳时间
+    PROCESS = struct.Struct('<qd')
+    # 头部计数器
+    TOTAL_REQUESTS, DAILY_REQUESTS, YESTERDAY_REQUESTS, JOURNAL_SEQ = range(4)
+    # 历史统计的计数器个数
+    STATS = 32
+
+    def __init__(self, path, slots, processes):
+        self.slots = slots
+        self.processes = processes
+        self.process_offset = self.HEADER_SIZE + slots * self.SLOT.size
+        counts_offset = self.process_offset + processes * self.PROCESS.size
+        self.stats_offset = counts_offset + slots * processes * 4
+        self.size = self.stats_offset + self.STATS * 8
+        self.lock = threading.RLock()
+        # 域名 -> 槽位下标
+        self.index = {}
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._locked(0, self.HEADER_SIZE):
+            if os.fstat(self.fd).st_size < self.size:
+                os.ftruncate(self.fd, self.size)
+            self.map = mmap.mmap(self.fd, self.size)
+            magic, table_slots = self.HEADER.unpack_from(self.map, 0)[:2]
+            table_processes = self.HEADER.unpack_from(self.map, 0)[-1]
+            # 第一个打开共享表的进程负责初始化
+            self.created = magic != self.MAGIC
+            if self.created:
+                self.map[:] = bytes(self.size)
+                self.HEADER.pack_into(self.map, 0, self.MAGIC, slots, 0, 0, 0, 0, processes)
+            elif table_slots != slots or table_processes != processes:
+                raise RuntimeError(f'共享表大小不一致：{table_slots}/{table_processes} != {slots}/{processes}，'
+                                   f'请删除{path}后重启')
+            # 每个槽位上各进程占用的载荷：counts[槽位 * 进程数 + 进程下标]
+            self.counts = memoryview(self.map)[counts_offset:self.stats_offset].cast('i')
+            self.process = self._register()
+
+    @contextlib.contextmanager
+    def _locked(self, offset, length):
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+    @staticmethod
+    def _counter_offset(index):
+        return 8 + 8 * index
+
+    def counter(self, index):
+        return struct.unpack_from('<q', self.map, self._counter_offset(index))[0]
+
+    # 多个计数器一起加一，返回最后一个计数器的新值
+    def add_counters(self, *indexes):
+        with self._locked(8, 32):
+            for index in indexes:
+                offset = self._counter_offset(index)
+                value = struct.unpack_from('<q', self.map, offset)[0] + 1
+                struct.pack_into('<q', self.map, offset, value)
+        return value
+
+    def set_counter(self, index, value):
+        with self._locked(8, 32):
+            struct.pack_into('<q', self.map, self._counter_offset(index), value)
+
+    # 计数器至少为 value
+    def raise_counter(self, index, value):
+        with self._locked(8, 32):
+            offset = self._counter_offset(index)
+            if struct.unpack_from('<q', self.map, offset)[0] < value:
+                struct.pack_into('<q', self.map, offset, value)
+
+    def add_stat(self, index, delta=1):
+        offset = self.stats_offset + 8 * index
+        with self._locked(offset, 8):
+            struct.pack_into('<q', self.map, offset, struct.unpack_from('<q', self.map, offset)[0] + delta)
+
+    def stats(self):
+        return struct.unpack_from(f'<{self.STATS}q', self.map, self.stats_offset)
+
+    # 日请求数转为昨日请求数
+    def reset_daily(self):
+        with self._locked(8, 32):
+            daily = self.counter(self.DAILY_REQUESTS)
+            struct.pack_into('<q', self.map, self._counter_offset(self.YESTERDAY_REQUESTS), daily)
+            struct.pack_into('<q', self.map, self._counter_offset(self.DAILY_REQUESTS), 0)
+
+    def _slot_offset(self, index):
+        return self.HEADER_SIZE + index * self.SLOT.size
+
+    def _process_offset(self, process):
+        return self.process_offset + process * self.PROCESS.size
+
+    # 登记本进程：优先使用空闲的进程表项，其次是已退出的进程留下的表项（先归还其载荷）；调用方需锁住头部
+    def _register(self):
+        pid = os.getpid()
+        entries = [self.PROCESS.unpack_from(self.map, self._process_offset(i)) for i in range(self.processes)]
+        candidates = ([i for i, (owner, _) in enumerate(entries) if owner in (0, pid)] +
+                      [i for i, (owner, beat) in enumerate(entries) if self._dead(owner, beat, time.time())])
+        if not candidates:
+            raise RuntimeError(f'共享表进程数已满（{self.processes}）')
+        process = candidates[0]
+        self._release_process(process)
+        self.PROCESS.pack_into(self.map, self._process_offset(process), pid, time.time())
+        return process
+
+    @staticmethod
+    def _dead(pid, beat, now):
+        if not pid:
+            return False
+        if now - beat > shared_process_timeout:
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    # 归还进程表项在各槽位上占用的载荷，返回归还的总数
+    def _release_process(self, process):
+        released = 0
+        for index in range(self.slots):
+            if self.counts[index * self.processes + process]:
+                offset = self._slot_offset(index) + 4
+                with self._locked(offset, 4):
+                    count = self.counts[index * self.processes + process]
+                    load = struct.unpack_from('<i', self.map, offset)[0]
+                    struct.pack_into('<i', self.map, offset, max(load - count, 0))
+                    self.counts[index * self.processes + process] = 0
+                    released += count
+        return released
+
+    # 更新本进程的心跳；表项已被当作退出进程回收时重新登记
+    def heartbeat(self):
+        with self._locked(0, self.HEADER_SIZE):
+            offset = self._process_offset(self.process)
+            if self.PROCESS.unpack_from(self.map, offset)[0] != os.getpid():
+                self.process = self._register()
+            else:
+                self.PROCESS.pack_into(self.map, offset, os.getpid(), time.time())
+
+    # 回收已退出或长时间没有心跳的进程占用的载荷，返回 [(进程号, 归还的载荷)]
+    def reclaim(self):
+        reclaimed = []
+        now = time.time()
+        with self._locked(0, self.HEADER_SIZE):
+            for process in range(self.processes):
+                if process == self.process:
+                    continue
+                offset = self._process_offset(process)
+                pid, beat = self.PROCESS.unpack_from(self.map, offset)
+                if self._dead(pid, beat, now):
+                    reclaimed.append((pid, self._release_process(process)))
+                    self.PROCESS.pack_into(self.map, offset, 0, 0.0)
+        return reclaimed
+
+    def _holds(self, index, key):
+        used, _, _, _, name = self.SLOT.unpack_from(self.map, self._slot_offset(index))
+        return used == self.USED and name.rstrip(b'\0') == key
+
+    # 查找域名对应的槽位（开放寻址），allocate 为True时不存在则分配，优先复用查找路径上已释放的槽位
+    # 调用方需锁住头部
+    def _find(self, key, allocate):
+        start = zlib.crc32(key) % self.slots
+        deleted = None
+        for i in range(self.slots):
+            index = (start + i) % self.slots
+            used, _, _, _, name = self.SLOT.unpack_from(self.map, self._slot_offset(index))
+            if used == self.FREE:
+                break
+            if used == self.DELETED:
+                if deleted is None:
+                    deleted = index
+            elif name.rstrip(b'\0') == key:
+                return index
+        else:
+            if deleted is None and allocate:
+                raise RuntimeError('共享表已满')
+            index = None
+        if not allocate:
+            return None
+        index = index if deleted is None else deleted
+        self.SLOT.pack_into(self.map, self._slot_offset(index), self.USED, 0, 0.0, 1.0, key)
+        return index
+
+    # 查找或分配域名对应的槽位，分配时锁住头部；其他进程可能已释放并复用缓存的槽位，使用前先核对
+    def slot(self, domain):
+        key = domain.encode('utf-8')[:272]
+        index = self.index.get(domain)
+        if index is not None and self._holds(index, key):
+            return index
+        with self._locked(0, self.HEADER_SIZE):
+            index = self._find(key, True)
+        self.index[domain] = index
+        return index
+
+    # 节点移除后释放槽位，标记为已释放以免截断其他域名的查找路径
+    def free(self, domain):
+        self.index.pop(domain, None)
+        with self._locked(0, self.HEADER_SIZE):
+            index = self._find(domain.encode('utf-8')[:272], False)
+            if index is not None:
+                with self._locked(self._slot_offset(index), self.SLOT.size):
+                    self.SLOT.pack_into(self.map, self._slot_offset(index), self.DELETED, 0, 0.0, 1.0, b'')
+                    start = index * self.processes
+                    self.counts[start:start + self.processes] = array.array('i', bytes(4 * self.processes))
+
+    def load(self, index):
+        return struct.unpack_from('<i', self.map, self._slot_offset(index) + 4)[0]
+
+    # 原子地修改载荷，指定 limit 时载荷已达上限返回None；同时记录本进程占用的载荷，
+    # 只归还本进程占用的部分，载荷被当作退出进程回收过之后再释放不会重复扣减
+    def add_load(self, index, delta, limit=None):
+        offset = self._slot_offset(index) + 4
+        own = index * self.processes + self.process
+        with self._locked(offset, 4):
+            load = struct.unpack_from('<i', self.map, offset)[0]
+            if limit is not None and load >= limit:
+                return None
+            delta = max(delta, -self.counts[own])
+            load = max(load + delta, 0)
+            self.counts[own] += delta
+            struct.pack_into('<i', self.map, offset, load)
+        return load
+
+    def set_health(self, index, rtt, success):
+        offset = self._slot_offset(index) + 8
+        with self._locked(offset, 16):
+            struct.pack_into('<dd', self.map, offset, rtt, success)
+
+    # 返回 (检测耗时, 成功率)，未检测过时耗时为None
+    def health(self, index):
+        rtt, success = struct.unpack_from('<dd', self.map, self._slot_offset(index) + 8)
+        return (rtt or None), success
+
+
+# 数据持久化：快照 + 追加写的变更日志
+# 结构性变更（上传、移入/移出回收站、删除、封禁、新token）追加到 journal.log，
+# 定期把完整状态原子写入 snapshot.json 后轮换日志；启动时加载快照并重放快照之后的日志
+# 共享模式下各进程在文件锁内直接追加日志（序号由共享表分配），并读取其他进程追加的日志同步状态
+class DataStore:
+    def __init__(self, directory):
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.journal_path = os.path.join(directory, 'journal.log')
+        # 快照写入完成前保留的上一份日志
+        self.rotated_path = self.journal_path + '.1'
+        self.lock = threading.RLock()
+        self.file = None
+        self.seq = 0
+        self.buffer = []
+        # 自上次快照以来写入日志的条目数
+        self.entries = 0
+        # 是否有只保存在快照中的变更（检测时间、token续期等）
+        self.touched = False
+        self.snapshot_time = time.time()
+        # 共享模式相关：共享表、日志文件锁、进程标识、读取其他进程日志的文件与未读完的半行
+        self.shared = None
+        self.lock_file = None
+        self.origin = os.getpid()
+        self.tail_file = None
+        self.tail_buffer = ''
+        self.unsynced = False
+        self.replaying = threading.local()
+        # 变更的监听者（多实例同步），在调用方持有的锁内调用
+        self.listener = None
+
+    def enable_shared(self, table):
+        self.shared = table
+        self.lock_file = open(self.journal_path + '.lock', 'a')
+
+    @contextlib.contextmanager
+    def _journal_locked(self):
+        if not self.lock_file:
+            yield
+            return
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    # 同步其他进程的变更时不再写入日志
+    @contextlib.contextmanager
+    def replay(self):
+        self.replaying.active = True
+        try:
+            yield
+        finally:
+            self.replaying.active = False
+
+    def is_replaying(self):
+        return getattr(self.replaying, 'active', False)
+
+    def record(self, op, **fields):
+        if self.is_replaying():
+            return
+        if self.listener:
+            self.listener(op, fields)
+        with self.lock:
+            fields['op'] = op
+            if not self.shared:
+                self.seq += 1
+                fields['seq'] = self.seq
+                self.buffer.append(json.dumps(fields, ensure_ascii=False))
+                return
+            with self._journal_locked():
+                self.seq = fields['seq'] = self.shared.add_counters(SharedTable.JOURNAL_SEQ)
+                fields['origin'] = self.origin
+                self._open_journal()
+                self.file.write(json.dumps(fields, ensure_ascii=False) + '\n')
+                self.file.flush()
+                self.entries += 1
+                self.unsynced = True
+
+    # 日志被其他进程轮换后重新打开
+    def _open_journal(self):
+        if self.file is not None:
+            try:
+                if os.fstat(self.file.fileno()).st_ino == os.stat(self.journal_path).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self.file.close()
+        self.file = open(self.journal_path, 'a', encoding='utf-8')
+
+    def touch(self):
+        self.touched = True
+
+    # 将缓冲的变更一次性追加到日志，没有变更时直接返回
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = False
+        if not self.buffer:
+            return False
+        if self.file is None:
+            self.file = open(self.journal_path, 'a', encoding='utf-8')
+        self.file.write('\n'.join(self.buffer) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entries += len(self.buffer)
+        self.buffer = []
+        return True
+
+    def should_compact(self):
+        if self.entries >= compact_entries:
+            return True
+        return (self.entries or self.touched) and time.time() - self.snapshot_time >= compact_interval
+
+    # 独占日志：共享模式下生成快照期间其他进程不能追加日志
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self.lock, self._journal_locked():
+            yield
+
+    # 轮换日志并返回当前序号，调用方需保证此时状态不再变化
+    def rotate(self):
+        with self.lock:
+            self._flush()
+            if self.file:
+                self.file.close()
+                self.file = None
+            if os.path.exists(self.journal_path):
+                os.replace(self.journal_path, self.rotated_path)
+            if self.shared:
+                # 立即创建新日志，其他进程据此发现日志已轮换
+                open(self.journal_path, 'a').close()
+                self.seq = self.shared.counter(SharedTable.JOURNAL_SEQ)
+            self.entries = 0
+            self.touched = False
+            return self.seq
+
+    def write_snapshot(self, state, seq):
+        state['seq'] = seq
+        write_json_atomic(self.snapshot_path, state)
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+        self.snapshot_time = time.time()
+
+    # 读取其他进程新追加的日志，日志轮换后读完旧文件再切换到新文件
+    def tail(self):
+        entries = []
+        with self.lock:
+            if self.tail_file is None:
+                return entries
+            while True:
+                self.tail_buffer += self.tail_file.read()
+                lines = self.tail_buffer.split('\n')
+                self.tail_buffer = lines.pop()
+                for line in lines:
+                    if not line:
+                        continue
+                    entry = json.loads(line)
+                    if entry.get('origin') != self.origin:
+                        self.entries += 1
+                        entries.append(entry)
+                try:
+                    rotated = os.fstat(self.tail_file.fileno()).st_ino != os.stat(self.journal_path).st_ino
+                except FileNotFoundError:
+                    rotated = False
+                if not rotated:
+                    return entries
+                self.tail_file.close()
+                self.tail_file = open(self.journal_path, 'r', encoding='utf-8')
+                self.tail_buffer = ''
+
+    # 加载快照并重放日志，快照和日志都不存在时返回None
+    def load(self):
+        with self._journal_locked():
+            state = self._load()
+            if self.shared:
+                open(self.journal_path, 'a').close()
+                self.tail_file = open(self.journal_path, 'r', encoding='utf-8')
+                self.tail_file.seek(0, os.SEEK_END)
+                self.shared.raise_counter(SharedTable.JOURNAL_SEQ, self.seq)
+        return state
+
+    def _load(self):
+        state = None
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            pass
+        journals = [path for path in (self.rotated_path, self.journal_path)
+                    if os.path.exists(path) and os.path.getsize(path)]
+        if state is None and not journals:
+            return None
+        state = state or {'seq': 0}
+        pool = {node['domain']: node for node in state.get('node_pool', [])}
+        recycle = {node['domain']: node for node in state.get('recycle_bin', [])}
+        tokens = {token['token']: token['expire_time'] for token in state.get('tokens', [])}
+        blocks = {block['domain']: block for block in state.get('block_domains', [])}
+        seq = state['seq']
+        for path in journals:
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 崩溃时写了一半的最后一行
+                        log(f'变更日志{path}存在不完整的记录，已忽略')
+                        break
+                    if entry['seq'] <= seq:
+                        continue
+                    seq = entry['seq']
+                    self._apply(entry, pool, recycle, tokens, blocks)
+        self.seq = seq
+        return {
+            'node_pool': list(pool.values()),
+            'recycle_bin': list(recycle.values()),
+            'tokens': [{'token': token, 'expire_time': expire_time} for token, expire_time in tokens.items()],
+            'block_domains': list(blocks.values()),
+        }
+
+    @staticmethod
+    def _apply(entry, pool, recycle, tokens, blocks):
+        op = entry['op']
+        if op == 'add':
+            recycle.pop(entry['node']['domain'], None)
+            pool[entry['node']['domain']] = entry['node']
+        elif op == 'recycle':
+            node = pool.pop(entry['domain'], None)
+            if node:
+                node['timestamp'] = entry.get('timestamp', node.get('timestamp'))
+                recycle[entry['domain']] = node
+        elif op == 'restore':
+            node = recycle.pop(entry['domain'], None)
+            if node:
+                node['timestamp'] = entry.get('timestamp', node.get('timestamp'))
+                pool[entry['domain']] = node
+        elif op == 'remove':
+            pool.pop(entry['domain'], None)
+            recycle.pop(entry['domain'], None)
+        elif op == 'block':
+            blocks[entry['domain']] = {key: entry[key] for key in ('domain', 'time', 'expire') if key in entry}
+        elif op == 'unblock':
+            blocks.pop(entry['domain'], None)
+        elif op == 'clear_blocks':
+            blocks.clear()
+        elif op == 'token':
+            tokens[entry['token']] = entry['expire_time']
+        elif op == 'tokens':
+            tokens.update(entry['expires'])
+
+
+store = DataStore(data_dir)
+registry.journal = store
+token_store.journal = store
+
+# 共享模式下的共享表，启动时打开
+shared_table = None
+
+
+def open_shared_table():
+    global shared_table
+    shared_table = SharedTable(os.path.join(data_dir, 'shared.bin'), shared_slots, shared_processes)
+    registry.shared = shared_table
+    store.enable_shared(shared_table)
+
+
+# 将其他进程写入的变更应用到本进程的注册表与token存储
+def apply_journal_entry(entry):
+    op = entry['op']
+    with store.replay():
+        if op == 'add':
+            node = dict(entry['node'], load=0)
+            registry.remove(node['domain'])
+            registry.add(node)
+        elif op == 'recycle':
+            node = registry.pool.get(entry['domain'])
+            if node:
+                node['timestamp'] = entry.get('timestamp', node.get('timestamp'))
+                registry.move_to_recycle(node)
+        elif op == 'restore':
+            node = registry.recycle.get(entry['domain'])
+            if node:
+                node['timestamp'] = entry.get('timestamp', node.get('timestamp'))
+                registry.restore(node)
+        elif op == 'remove':
+            registry.remove(entry['domain'])
+        elif op == 'block':
+            registry.block(entry['domain'], entry['time'], entry.get('expire'))
+        elif op == 'unblock':
+            registry.unblock(entry['domain'])
+        elif op == 'clear_blocks':
+            registry.clear_blocks()
+        elif op == 'token':
+            token_store.set_expires({entry['token']: entry['expire_time']})
+        elif op == 'tokens':
+            token_store.set_expires(entry['expires'])
+        elif op == 'verify':
+            upload_verifier.apply(entry)
+
+
+# 节点全部满载时的等待队列：先进先出，载荷释放时只唤醒队首请求，超出队列长度或等待时间时直接失败
+class WaitQueue:
+    def __init__(self, max_length, max_wait):
+        self.lock = threading.Lock()
+        self.waiters = collections.deque()
+        self.max_length = max_length
+        self.max_wait = max_wait
+        # 最近的等待耗时，用于统计分位数
+        self.wait_times = collections.deque(maxlen=1000)
+        self.rejected = 0
+        self.timeouts = 0
+
+    def __len__(self):
+        return len(self.waiters)
+
+    # try_acquire 返回None表示暂无可用资源；排队失败或等待超时返回None
+    def acquire(self, try_acquire):
+        with self.lock:
+            if not self.waiters:
+                result = try_acquire()
+                if result is not None:
+                    return result
+            if len(self.waiters) >= self.max_length:
+                self.rejected += 1
+                return None
+            ticket = threading.Event()
+            self.waiters.append(ticket)
+
+        start = time.time()
+        deadline = start + self.max_wait
+        try:
+            while True:
+                with self.lock:
+                    if self.waiters[0] is ticket:
+                        result = try_acquire()
+                        if result is not None:
+                            self.wait_times.append(time.time() - start)
+                            return result
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        self.wait_times.append(time.time() - start)
+                        return None
+                    ticket.clear()
+                ticket.wait(remaining)
+        finally:
+            # 获取成功、超时或 try_acquire 出错时都要移出队列，并唤醒新的队首（可能还有剩余的空闲载荷）
+            with self.lock:
+                self.waiters.remove(ticket)
+                self._wake_head()
+
+    # 有载荷释放或新节点加入时调用
+    def notify(self):
+        with self.lock:
+            self._wake_head()
+
+    def _wake_head(self):
+        if self.waiters:
+            self.waiters[0].set()
+
+    # 返回最近等待耗时的分位数（秒）
+    def percentiles(self, *quantiles):
+        samples = sorted(self.wait_times)
+        if not samples:
+            return [0] * len(quantiles)
+        return [round(samples[min(int(len(samples) * q), len(samples) - 1)], 3) for q in quantiles]
+
+
+wait_queue = WaitQueue(max_wait_queue, max_wait_time)
+
+
+# 时间轮：由单个线程按 tick 推进，到期后执行回调，用于替代每个请求一个 threading.Timer
+# 添加定时任务只需向槽位追加一项，超过一圈的延时用剩余圈数表示
+class TimerWheel:
+    def __init__(self, tick=0.1, size=512, name="Timer wheel"):
+        self.tick = tick
+        self.size = size
+        self.slots = [[] for _ in range(size)]
+        self.cursor = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.name = name
+        self.thread = None
+
+    def __len__(self):
+        return self.pending
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+
+    # delay 秒后执行 callback，返回的任务可以传给 cancel 取消
+    def schedule(self, delay, callback):
+        ticks = max(1, math.ceil(delay / self.tick))
+        task = [(ticks - 1) // self.size, callback]
+        with self.lock:
+            self.slots[(self.cursor + ticks) % self.size].append(task)
+            self.pending += 1
+        return task
+
+    @staticmethod
+    def cancel(task):
+        task[1] = None
+
+    def _advance(self):
+        with self.lock:
+            self.cursor = (self.cursor + 1) % self.size
+            slot = self.slots[self.cursor]
+            due = [task for task in slot if task[0] == 0]
+            if not due:
+                for task in slot:
+                    task[0] -= 1
+                return []
+            waiting = []
+            for task in slot:
+                if task[0] > 0:
+                    task[0] -= 1
+                    waiting.append(task)
+            self.slots[self.cursor] = waiting
+            self.pending -= len(due)
+        return due
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick
+            delay = next_tick - time.monotonic()
+            # 落后时不再睡眠，连续推进直到追上
+            if delay > 0:
+                time.sleep(delay)
+            for task in self._advance():
+                if task[1] is None:
+                    continue
+                try:
+                    task[1]()
+                except Exception as e:
+                    log(f'定时任务执行出错：{e}')
+
+
+# 所有节点载荷到期释放共用一个时间轮，启动时开始转动
+load_timer = TimerWheel(name="Load expiry")
+
+
+# 租约表：每次分配节点占用一个载荷并发放租约，主动释放或过期时归还载荷，同时记录实际占用时长
+# 租约只保存在发放它的进程中，共享模式下 /release 落到其他 worker 时只能等待过期
+class LeaseTable:
+    def __init__(self, ttl):
+        self.lock = threading.Lock()
+        # 租约id -> [节点, 发放时间, 过期任务]
+        self.leases = {}
+        self.ttl = ttl
+        self.released = 0
+        self.expired = 0
+        # 已结束租约的累计占用时长
+        self.hold_time = 0.0
+
+    def __len__(self):
+        return len(self.leases)
+
+    # 为已经占用载荷的节点发放租约，返回租约id
+    def issue(self, node):
+        lease_id = os.urandom(8).hex()
+        with self.lock:
+            task = load_timer.schedule(self.ttl, lambda: self.end(lease_id, 'expired'))
+            self.leases[lease_id] = [node, time.monotonic(), task]
+        return lease_id
+
+    # 结束租约并归还载荷，租约不存在（已释放或已过期）时返回False
+    def end(self, lease_id, reason='released'):
+        with self.lock:
+            lease = self.leases.pop(lease_id, None)
+            if lease is None:
+                return False
+            node, issued, task = lease
+            held = time.monotonic() - issued
+            self.hold_time += held
+            if reason == 'released':
+                self.released += 1
+                TimerWheel.cancel(task)
+            else:
+                self.expired += 1
+        reduce_load(node)
+        metrics.observe('fqweb_lease_hold_seconds', held, (('end', reason),))
+        return True
+
+    def mean_hold_time(self):
+        ended = self.released + self.expired
+        return round(self.hold_time / ended, 3) if ended else 0
+
+
+lease_table = LeaseTable(lease_ttl)
+
+
+# 响应缓存：按最近最少使用淘汰，响应体总大小不超过 max_bytes，每个条目有各自的过期时间
+class ResponseCache:
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.lock = threading.Lock()
+        # key -> (过期时间, 状态码, 响应头, 响应体)
+        self.entries = collections.OrderedDict()
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # 返回 (状态码, 响应头, 响应体)，未命中或已过期返回None
+    def get(self, key):
+        if not self.max_bytes:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1:]
+
+    def put(self, key, ttl, status, headers, body):
+        if not self.max_bytes or len(body) > self.max_entry_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._pop(key)
+            self.entries[key] = (time.time() + ttl, status, headers, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _pop(self, key):
+        entry = self.entries.pop(key)
+        self.size -= len(entry[3])
+
+
+response_cache = ResponseCache(cache_max_bytes, cache_max_entry_bytes)
+
+
+# 按快照版本缓存的响应体：版本变化或超过 ttl 秒后重新生成，并发时可能重复生成，结果相同
+class BodyCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # 名称 -> (版本, 生成时间, 响应体)
+        self.entries = {}
+
+    def get(self, name, version, build):
+        entry = self.entries.get(name)
+        now = time.monotonic()
+        if entry and entry[0] == version and now - entry[1] < self.ttl:
+            return entry[2]
+        body = build()
+        self.entries[name] = (version, now, body)
+        return body
+
+
+body_cache = BodyCache(body_cache_ttl)
+
+
+# 相同请求合并（single-flight）：同一时间只有第一个请求访问节点，其余相同的请求等待并共享它的响应
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [Event, (状态码, 响应头, 响应体)]
+        self.calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.fallbacks = 0
+
+    # 返回 (是否为首个请求, call)
+    def join(self, key):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                return False, call
+            call = self.calls[key] = [threading.Event(), None]
+            self.leaders += 1
+            return True, call
+
+    # 等待首个请求的结果，超时或首个请求失败返回None
+    def wait(self, call, timeout):
+        result = call[1] if call[0].wait(timeout) else None
+        with self.lock:
+            if result is None:
+                self.fallbacks += 1
+            else:
+                self.coalesced += 1
+        return result
+
+    # 首个请求结束时调用，result 为None时等待者各自请求节点；重复调用不生效
+    def finish(self, key, call, result=None):
+        with self.lock:
+            if call[0].is_set():
+                return
+            if self.calls.get(key) is call:
+                del self.calls[key]
+            call[1] = result
+            call[0].set()
+
+    def rate(self):
+        total = self.leaders + self.coalesced + self.fallbacks
+        return round(self.coalesced / total * 100, 2) if total else 0
+
+
+single_flight = SingleFlight()
+
+
+# 指标采集：每个线程只写自己的分片，记录指标时不加锁，导出时再汇总所有分片
+# 线程退出后它的分片并入 retired，避免每个请求一个线程时分片无限增长
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # [(线程, 分片)]，分片为 (指标名, 标签) -> 计数或直方图数组
+        self.shards = []
+        self.retired = {}
+        # 指标名 -> (类型, 说明, 直方图分桶)
+        self.definitions = {}
+
+    def define(self, name, kind, help_text, buckets=None):
+        self.definitions[name] = (kind, help_text, buckets)
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    # 直方图数组：各分桶计数（最后一个为+Inf），总和，总数
+    def observe(self, name, value, labels=()):
+        shard = self._shard()
+        key = (name, labels)
+        histogram = shard.get(key)
+        buckets = self.definitions[name][2]
+        if histogram is None:
+            histogram = shard[key] = [0] * (len(buckets) + 3)
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    @staticmethod
+    def _merge(target, shard):
+        for key, value in list(shard.items()):
+            if isinstance(value, list):
+                merged = target.setdefault(key, [0] * len(value))
+                for i, item in enumerate(value):
+                    merged[i] += item
+            else:
+                target[key] = target.get(key, 0) + value
+
+    def collect(self):
+        with self.lock:
+            alive = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge(self.retired, shard)
+            self.shards = alive
+            total = {}
+            self._merge(total, self.retired)
+            for _, shard in alive:
+                self._merge(total, shard)
+        return total
+
+    # 以 Prometheus 文本格式导出，gauges 为 [(指标名, 标签, 值)]，由调用方在导出时计算
+    def render(self, gauges=()):
+        samples = collections.defaultdict(list)
+        for (name, labels), value in self.collect().items():
+            samples[name].append((labels, value))
+        for name, labels, value in gauges:
+            samples[name].append((labels, value))
+        lines = []
+        for name, (kind, help_text, buckets) in self.definitions.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(samples.get(name, []), key=lambda sample: sample[0]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {round(value[-2], 6)}')
+                lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+metrics = Metrics()
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+metrics.define('fqweb_http_requests_total', 'counter', '按接口与状态码统计的请求数')
+metrics.define('fqweb_http_request_duration_seconds', 'histogram', '按接口统计的请求耗时（代理模式为收到响应头的耗时）',
+               latency_buckets)
+metrics.define('fqweb_node_selections_total', 'counter', '各节点被选中的次数')
+metrics.define('fqweb_node_load', 'gauge', '节点池中各节点的当前载荷')
+metrics.define('fqweb_node_rtt_seconds', 'gauge', '各节点检测耗时的EWMA')
+metrics.define('fqweb_node_success_ratio', 'gauge', '各节点检测成功率的EWMA')
+metrics.define('fqweb_nodes', 'gauge', '节点池与回收站的节点数')
+metrics.define('fqweb_load_total', 'gauge', '节点池的总载荷')
+metrics.define('fqweb_load_capacity', 'gauge', '节点池的载荷上限')
+metrics.define('fqweb_probes_total', 'counter', '按类型统计的健康检测次数')
+metrics.define('fqweb_probe_failures_total', 'counter', '按类型统计的健康检测失败次数')
+metrics.define('fqweb_probe_duration_seconds', 'histogram', '按类型统计的健康检测耗时', latency_buckets)
+metrics.define('fqweb_probe_pending', 'gauge', '已安排的健康检测数')
+metrics.define('fqweb_probe_lag_seconds', 'gauge', '上个维护周期内健康检测的最大调度延迟')
+metrics.define('fqweb_maintenance_duration_seconds', 'histogram', '维护周期（token续期、统计、持久化）的耗时',
+               latency_buckets)
+metrics.define('fqweb_wait_queue_length', 'gauge', '等待空闲节点的请求数')
+metrics.define('fqweb_wait_duration_seconds', 'histogram', '请求获取节点的耗时（含排队）', latency_buckets)
+metrics.define('fqweb_wait_rejected_total', 'counter', '队列已满被拒绝的请求数')
+metrics.define('fqweb_wait_timeouts_total', 'counter', '排队超时的请求数')
+metrics.define('fqweb_flush_duration_seconds', 'histogram', '变更日志写盘耗时', latency_buckets)
+metrics.define('fqweb_compact_duration_seconds', 'histogram', '生成快照的耗时', latency_buckets)
+metrics.define('fqweb_cache_requests_total', 'counter', '响应缓存的命中与未命中次数')
+metrics.define('fqweb_cache_evictions_total', 'counter', '响应缓存的淘汰次数')
+metrics.define('fqweb_cache_bytes', 'gauge', '响应缓存占用的字节数')
+metrics.define('fqweb_coalesced_total', 'counter', '合并到其他请求的请求数')
+metrics.define('fqweb_lease_hold_seconds', 'histogram', '租约从发放到释放或过期的实际占用时长', latency_buckets)
+metrics.define('fqweb_leases_active', 'gauge', '未结束的租约数')
+metrics.define('fqweb_upload_verifications_total', 'counter', '上传节点的检测结果')
+metrics.define('fqweb_pending_uploads', 'gauge', '待检测的上传节点数')
+metrics.define('fqweb_peer_syncs_total', 'counter', '向其他实例拉取增量的次数')
+metrics.define('fqweb_peer_entries_total', 'counter', '从其他实例合并的数据条数')
+metrics.define('fqweb_peers_alive', 'gauge', '在线的其他实例数')
+metrics.define('fqweb_startup_load_seconds', 'gauge', '启动时加载数据的耗时')
+metrics.define('fqweb_first_redirect_seconds', 'gauge', '从进程启动到第一次成功分配节点的耗时')
+
+
+# 采样分析器：后台线程按固定间隔采集其他线程的调用栈，结果为折叠栈格式（每行“线程;函数;…;函数 次数”，可直接生成火焰图）
+# 未启动时没有任何开销
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started = None
+        self.finished = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, interval):
+        with self.lock:
+            if self.running():
+                return False
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self.started = time.time()
+            self.finished = None
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, args=(seconds, interval), name="Profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(5)
+
+    def _run(self, seconds, interval):
+        own = threading.get_ident()
+        deadline = time.time() + seconds
+        while time.time() < deadline and not self.stop_event.wait(interval):
+            # 每个请求一个线程时线程名带有序号，去掉序号后同类线程的调用栈合并在一起
+            names = {thread.ident: re.sub(r'[-_ ]?\d+', '', thread.name) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'unknown'))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+        self.finished = time.time()
+
+    def dump(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+profiler = SamplingProfiler()
+# 最近的请求耗时分段，开启追踪后才记录
+traced_requests = collections.deque(maxlen=trace_history)
+# 最近的维护周期各阶段耗时
+cycle_timings = collections.deque(maxlen=60)
+NULL_SPAN = contextlib.nullcontext()
+
+
+# 记录请求中一个阶段的耗时；未开启追踪时直接返回空的上下文管理器
+def span(name):
+    if not trace_requests or not has_request_context() or 'spans' not in g:
+        return NULL_SPAN
+    return _span(name)
+
+
+@contextlib.contextmanager
+def _span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.spans.append({'name': name, 'start_ms': round((start - g.request_start) * 1000, 2),
+                        'duration_ms': round((time.perf_counter() - start) * 1000, 2)})
+
+
+# 定长时间序列：每个周期一行、每列一个指标，环形数组按 周期编号 % 行数 定位，stamps 记录每行对应的周期编号
+# 同一周期内多次写入时，计数类的列累加，取值类的列取最大值
+class TimeSeries:
+    def __init__(self, period, rows, columns):
+        self.period = period
+        self.rows = rows
+        self.columns = columns
+        self.stamps = array.array('q', [-1]) * rows
+        self.values = array.array('d', [0.0]) * (rows * len(columns))
+
+    def record(self, when, values, kinds):
+        stamp = int(when // self.period)
+        row = stamp % self.rows
+        offset = row * len(self.columns)
+        if self.stamps[row] != stamp:
+            self.stamps[row] = stamp
+            for i in range(len(self.columns)):
+                self.values[offset + i] = 0.0
+        for i, (value, kind) in enumerate(zip(values, kinds)):
+            if kind == 'sum':
+                self.values[offset + i] += value
+            else:
+                self.values[offset + i] = max(self.values[offset + i], value)
+
+    # 按时间顺序返回 [(周期开始时间, [各列的值])]，只包含保留期内有数据的周期
+    def samples(self, now, since=0):
+        current = int(now // self.period)
+        first = max(current - self.rows + 1, int(since // self.period))
+        result = []
+        for stamp in range(first, current + 1):
+            row = stamp % self.rows
+            if self.stamps[row] == stamp:
+                offset = row * len(self.columns)
+                result.append((stamp * self.period, list(self.values[offset:offset + len(self.columns)])))
+        return result
+
+    # 恢复保存的周期，超出保留期的丢弃
+    def load(self, samples, now):
+        current = int(now // self.period)
+        for when, values in samples:
+            stamp = int(when // self.period)
+            if current - self.rows < stamp <= current:
+                row = stamp % self.rows
+                self.stamps[row] = stamp
+                offset = row * len(self.columns)
+                self.values[offset:offset + len(self.columns)] = array.array('d', values)
+
+
+# 请求与节点的历史统计：按接口的请求数、503数、健康检测次数与失败数、节点数、载荷与容量
+# 请求与检测次数取 metrics 累计值的差值，节点数与载荷为采样时的值，汇总时取周期内的最大值
+# 持久化为 history.bin：JSON头（列名、各序列的行数）+ 各序列有数据的周期（开始时间与各列的值），整体zlib压缩
+class History:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.routes = ['/random'] + [f'/{url}' for url in allow_urls]
+        self.columns = ([f'requests:{route}' for route in self.routes] +
+                        ['requests:other', 'busy', 'probes', 'probe_failures',
+                         'active_nodes', 'recycle_nodes', 'load', 'capacity'])
+        self.kinds = ['sum'] * (len(self.routes) + 4) + ['max'] * 4
+        self.series = {'minute': TimeSeries(60, history_minutes, self.columns),
+                       'hour': TimeSeries(3600, history_hours, self.columns)}
+        # 共享模式下请求数与503数记录在共享表中，按列的顺序对应共享表的计数器
+        self.shared_columns = self.columns[:len(self.routes) + 2]
+        # 上次采样时各计数的累计值
+        self.last = {}
+        self.saved_time = time.time()
+        # 是否由本进程采样；共享模式下不采样的进程查询时按文件的修改时间重新加载
+        self.sampling = False
+        self.loaded_mtime = None
+
+    # 共享模式下所有 worker 的请求都计入共享表
+    def count_request(self, route, status):
+        route = route if route in self.routes else 'other'
+        shared_table.add_stat(self.shared_columns.index(f'requests:{route}'))
+        if status == 503:
+            shared_table.add_stat(self.shared_columns.index('busy'))
+
+    def _counters(self):
+        counters = collections.defaultdict(float)
+        if shared_table:
+            counters.update(zip(self.shared_columns, shared_table.stats()))
+        for (name, labels), value in metrics.collect().items():
+            labels = dict(labels)
+            if name == 'fqweb_http_requests_total':
+                if shared_table:
+                    continue
+                route = labels['route'] if labels['route'] in self.routes else 'other'
+                counters[f'requests:{route}'] += value
+                if labels['status'] == '503':
+                    counters['busy'] += value
+            elif name == 'fqweb_probes_total':
+                counters['probes'] += value
+            elif name == 'fqweb_probe_failures_total':
+                counters['probe_failures'] += value
+        return counters
+
+    def sample(self):
+        now = time.time()
+        counters = self._counters()
+        active = registry.pool_count()
+        gauges = {'active_nodes': active, 'recycle_nodes': registry.recycle_count(), 'load': get_all_loads(),
+                  'capacity': active * max_load_per_node}
+        with self.lock:
+            values = []
+            for column, kind in zip(self.columns, self.kinds):
+                if kind == 'sum':
+                    values.append(max(counters[column] - self.last.get(column, 0), 0))
+                else:
+                    values.append(gauges[column])
+            self.last = counters
+            for series in self.series.values():
+                series.record(now, values, self.kinds)
+
+    def query(self, resolution, since=0):
+        if shared_table and not self.sampling:
+            self.reload()
+        with self.lock:
+            return self.series[resolution].samples(time.time(), since)
+
+    # 文件在上次加载后有更新时重新加载
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime != self.loaded_mtime:
+            self.load()
+
+    def save(self):
+        now = time.time()
+        with self.lock:
+            header = {'columns': self.columns}
+            body = []
+            for name, series in self.series.items():
+                samples = series.samples(now)
+                header[name] = len(samples)
+                body.append(array.array('q', [int(when) for when, _ in samples]).tobytes())
+                body.append(array.array('d', [value for _, values in samples for value in values]).tobytes())
+        write_file_atomic(self.path, zlib.compress(json.dumps(header).encode('utf-8') + b'\n' + b''.join(body)))
+        self.saved_time = now
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as file:
+                mtime = os.fstat(file.fileno()).st_mtime
+                data = zlib.decompress(file.read())
+        except FileNotFoundError:
+            return
+        except zlib.error as e:
+            log(f'历史统计文件损坏：{e}')
+            return
+        header, body = data.split(b'\n', 1)
+        header = json.loads(header)
+        # 列可能随版本变化，按列名对应，缺少的列为0
+        mapping = [header['columns'].index(column) if column in header['columns'] else None
+                   for column in self.columns]
+        width = len(header['columns'])
+        offset = 0
+        now = time.time()
+        with self.lock:
+            for name, series in self.series.items():
+                count = header.get(name, 0)
+                stamps = array.array('q')
+                stamps.frombytes(body[offset:offset + count * 8])
+                offset += count * 8
+                values = array.array('d')
+                values.frombytes(body[offset:offset + count * width * 8])
+                offset += count * width * 8
+                series.load([(when, [0.0 if index is None else values[i * width + index] for index in mapping])
+                             for i, when in enumerate(stamps)], now)
+            self.loaded_mtime = mtime
+        log(f'加载历史统计')
+
+
+history = History(os.path.join(data_dir, 'history.bin'))
+
+
+# 上次保存的统计数据，未变化时跳过写入
+saved_statistics = None
+stats_lock = threading.Lock()
+
+
+# 请求计数加一
+def count_request():
+    global total_requests, daily_requests
+    if shared_table:
+        shared_table.add_counters(SharedTable.TOTAL_REQUESTS, SharedTable.DAILY_REQUESTS)
+        return
+    with stats_lock:
+        total_requests += 1
+        daily_requests += 1
+
+
+# 返回 (总请求数, 日请求数, 昨日请求数)
+def request_counts():
+    if shared_table:
+        return (shared_table.counter(SharedTable.TOTAL_REQUESTS), shared_table.counter(SharedTable.DAILY_REQUESTS),
+                shared_table.counter(SharedTable.YESTERDAY_REQUESTS))
+    return total_requests, daily_requests, yesterday_requests
+
+
 # 保存统计数据到文件的函数
 def save_statistics():
+    global saved_statistics
+    total, daily, yesterday = request_counts()
     stats = {
-        "total_requests": total_requests,
-        "daily_requests": daily_requests,
-        "yesterday_requests": yesterday_requests,
+        "total_requests": total,
+        "daily_requests": daily,
+        "yesterday_requests": yesterday,
         "shared_nodes": shared_nodes,
         "active_nodes": active_nodes,
         "start_time": start_time
     }
-    with open(os.path.join(data_dir, "statistics.json"), "w") as file:
-        json.dump(stats, file)
-        # log(f'保存统计数据')
+    if stats == saved_statistics:
+        return
+    write_json_atomic(os.path.join(data_dir, "statistics.json"), stats)
+    saved_statistics = stats
+    # log(f'保存统计数据')
 
 
 # 从文件加载统计数据的函数
@@ -95,16 +2138,53 @@ def load_statistics():
             shared_nodes = stats.get("shared_nodes", 0)
             active_nodes = stats.get("active_nodes", 0)
             start_time = stats.get("start_time", time.time())
+            # 共享表由本进程新建时，用文件中的计数初始化
+            if shared_table and shared_table.created:
+                shared_table.set_counter(SharedTable.TOTAL_REQUESTS, total_requests)
+                shared_table.set_counter(SharedTable.DAILY_REQUESTS, daily_requests)
+                shared_table.set_counter(SharedTable.YESTERDAY_REQUESTS, yesterday_requests)
             log(f'加载统计数据')
     except FileNotFoundError:
         pass
+    except ValueError as e:
+        log(f'统计数据文件损坏：{e}')
 
 
-# Load node pool and recycle bin from files (if available)
+# 从快照和变更日志加载数据，都不存在时从旧版的各个JSON文件迁移
 def load_data_from_file():
+    state = store.load()
+    if state is None:
+        load_legacy_data_from_file()
+        # 共享模式下只由负责健康检测的进程生成第一份快照
+        if not shared_table or acquire_leader():
+            compact_data()
+        return
+    for node in state['node_pool'] + state['recycle_bin']:
+        node['load'] = 0
+    # 最近检测通过的节点直接提供服务，其余节点等待重新检测
+    fresh = [node for node in state['node_pool'] if is_recently_healthy(node)]
+    stale_nodes[:] = [node for node in state['node_pool'] if not is_recently_healthy(node)]
+    registry.load(fresh, state['recycle_bin'] + stale_nodes, state['block_domains'])
+    token_store.load(state['tokens'])
+    log(f'加载快照与变更日志：节点池{registry.pool_count()}（另有{len(stale_nodes)}个待重新检测），'
+        f'回收站{registry.recycle_count() - len(stale_nodes)}，token{len(token_store)}，'
+        f'黑名单{len(state["block_domains"])}')
+
+
+# 节点最近一次检测通过（且之后没有失败的检测）的时间在 warm_restart_window 内，并且成功率足够高
+def is_recently_healthy(node):
+    timestamp = node.get('timestamp', 0)
+    return (time.time() - timestamp <= warm_restart_window and node.get('checked', timestamp) - timestamp < 1
+            and node.get('success', 1.0) >= warm_min_success)
+
+
+# Load node pool and recycle bin from files (if available)
+def load_legacy_data_from_file():
+    node_pool = []
+    recycle_bin = []
+    block_domains = []
     try:
         with open(os.path.join(data_dir, "node_pool.json"), "r") as node_pool_file:
-            global node_pool
             node_pool = json.load(node_pool_file)
             log(f'加载节点池数据')
     except FileNotFoundError:
@@ -112,7 +2192,6 @@ def load_data_from_file():
 
     try:
         with open(os.path.join(data_dir, "recycle_bin.json"), "r") as recycle_bin_file:
-            global recycle_bin
             recycle_bin = json.load(recycle_bin_file)
             log(f'加载回收站数据')
     except FileNotFoundError:
@@ -120,15 +2199,13 @@ def load_data_from_file():
 
     try:
         with open(os.path.join(data_dir, "tokens.json"), "r") as tokens_file:
-            global tokens
-            tokens = json.load(tokens_file)
+            token_store.load(json.load(tokens_file))
             log(f'加载tokens数据')
     except FileNotFoundError:
         pass
 
     try:
         with open(os.path.join(data_dir, "block_domains.json"), "r") as block_domains_file:
-            global block_domains
             block_domains = json.load(block_domains_file)
             log(f'加载block_domains数据')
     except FileNotFoundError:
@@ -136,33 +2213,50 @@ def load_data_from_file():
 
     for node in node_pool + recycle_bin:
         node['load'] = 0
+    registry.load(node_pool, recycle_bin, block_domains)
 
 
-# Save node pool and recycle bin to files
+# 将变更追加到日志，日志过长或距离上次快照过久时生成新快照
 def save_data_to_file():
-    with open(os.path.join(data_dir, "node_pool.json"), "w") as node_pool_file:
-        json.dump(node_pool, node_pool_file)
-        # log(f'保存节点池数据')
-
-    with open(os.path.join(data_dir, "recycle_bin.json"), "w") as recycle_bin_file:
-        json.dump(recycle_bin, recycle_bin_file)
-        # log(f'保存回收站数据')
-
-    with open(os.path.join(data_dir, "tokens.json"), "w") as tokens_file:
-        json.dump(tokens, tokens_file)
-        # log(f'保存tokens数据')
-
-
-# 在服务器启动时加载统计数据
-load_statistics()
-load_data_from_file()
+    flush_start = time.perf_counter()
+    store.flush()
+    metrics.observe('fqweb_flush_duration_seconds', time.perf_counter() - flush_start)
+    if store.should_compact():
+        compact_start = time.perf_counter()
+        compact_data()
+        metrics.observe('fqweb_compact_duration_seconds', time.perf_counter() - compact_start)
+
+
+# 生成快照：在注册表和token的锁内截取状态并轮换日志，锁外写入快照文件
+# 共享模式下先在日志锁内应用其他进程尚未读取的变更
+def compact_data():
+    with registry.lock, token_store.lock, store.exclusive():
+        for entry in store.tail():
+            apply_journal_entry(entry)
+        state = {
+            'node_pool': [persist_node(node) for node in registry.pool_nodes()],
+            'recycle_bin': [persist_node(node) for node in registry.recycle_nodes()],
+            'tokens': token_store.dump(),
+            'block_domains': registry.blocked(),
+        }
+        seq = store.rotate()
+    store.write_snapshot(state, seq)
+    # log(f'保存快照')
+
+
+# 重启时等待重新检测的节点
+stale_nodes = []
 
 
 # 每天零点清零日请求次数
 def reset_daily_requests():
     global daily_requests, yesterday_requests
-    yesterday_requests = daily_requests
-    daily_requests = 0
+    if shared_table:
+        shared_table.reset_daily()
+    else:
+        with stats_lock:
+            yesterday_requests = daily_requests
+            daily_requests = 0
     log(f'日请求清零')
 
 
@@ -170,22 +2264,51 @@ def reset_daily_requests():
 schedule.every().day.at("00:00").do(reset_daily_requests)
 
 
+# 健康检测共用的keep-alive连接池，每个节点保留一个长连接供下一轮检测复用
+check_session = requests.Session()
+check_session.mount('http://', HTTPAdapter(pool_connections=1024, pool_maxsize=2))
+check_executor = ThreadPoolExecutor(max_workers=check_concurrency, thread_name_prefix="Probe")
+# 代理模式转发请求用的会话：每个节点一个连接池，连接数与节点的最大载荷一致
+proxy_session = requests.Session()
+proxy_session.mount('http://', HTTPAdapter(pool_connections=1024, pool_maxsize=max_load_per_node))
+
+
 # Helper function to check if a domain is accessible (e.g., not 404)
 def is_domain_accessible(domain):
     try:
         # log(f'检测节点是否有效：{domain["domain"]}')
         url = f'http://{domain["domain"]}/content'
-        response = requests.get(url, timeout=10)
+        probe_start = time.time()
+        response = check_session.get(url, timeout=check_timeout)
+        record_probe(domain, response.status_code == 200, time.time() - probe_start)
+        domain['checked'] = time.time()
         if response.status_code == 200:
-            domain['timestamp'] = time.time()
+            domain['timestamp'] = domain['checked']
+            store.touch()
             return True
         else:
             return False
     except Exception as e:
+        record_probe(domain, False)
+        domain['checked'] = time.time()
         log(f'检测节点{domain["domain"]}出错：{e}')
         return False
 
 
+# 以EWMA记录节点的检测耗时与成功率，rtt 为 None 表示没有收到响应
+def record_probe(domain, success, rtt=None):
+    if rtt is not None:
+        domain['rtt'] = round(rtt if 'rtt' not in domain else ewma_alpha * rtt + (1 - ewma_alpha) * domain['rtt'], 4)
+    domain['success'] = round(ewma_alpha * success + (1 - ewma_alpha) * domain.get('success', 1.0), 4)
+    registry.publish_health(domain)
+
+
+# 节点的预计耗时：检测耗时 ×（载荷 + 1），近期失败越多惩罚越大
+def node_cost(domain):
+    return (domain.get('rtt', default_rtt) * (domain.get('load', 0) + 1)
+            * (1 + failure_penalty * (1 - domain.get('success', 1.0))))
+
+
 def is_valid_domain_name(domain):
     # 定义域名的正则表达式模式
     domain_pattern = r'^([a-zA-Z0-9]([a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,}(?::(\d{1,5}))?$'
@@ -197,117 +2320,738 @@ def is_valid_domain_name(domain):
         return False
 
 
-# Helper function to manage domain status in the node pool and recycle bin
-def manage_domains():
-    delta = 0
-    while True:
+# 重启后并发检测加载时放入回收站的节点，每个节点检测通过后立即恢复到节点池
+def verify_stale_nodes(nodes):
+    verify_start = time.time()
+    futures = {check_executor.submit(is_domain_accessible, node): node for node in nodes}
+    restored = 0
+    for future in as_completed(futures):
+        if future.result() and registry.restore(futures[future]):
+            restored += 1
+            wait_queue.notify()
+    log(f'重启后重新检测{len(nodes)}个节点完成，恢复{restored}个，耗时{round(time.time() - verify_start, 2)}秒')
+
+
+# 严格检测一次，返回 'ok'（节点对不存在的书籍返回“该书不存在”，或节点已失效）、
+# 'fake'（节点对不存在的书籍也返回了内容）、'error'（请求出错或其他状态码）
+def strict_probe(domain):
+    try:
+        # log(f'检测节点是否有效：{domain["domain"]}')
+        url = f'http://{domain["domain"]}/content?item_id=1'
+        registry.acquire(domain)
         try:
-            start_check_time = time.time()
-            # Move domains from node pool to recycle bin if they are not accessible
-            for domain in node_pool:
-                if domain['domain'] in [block['domain'] for block in block_domains]:
-                    node_pool.remove(domain)
-                    continue
-                if not is_domain_accessible(domain):
-                    recycle_bin.append(domain)
-                    node_pool.remove(domain)
+            probe_start = time.time()
+            response = check_session.get(url, timeout=check_timeout)
+        finally:
+            registry.release(domain)
+        # 节点失效不需要添加黑名单
+        if response.status_code == 404:
+            record_probe(domain, False, time.time() - probe_start)
+            return 'ok'
+        if response.status_code == 200 and '该书不存在' in response.text:
+            record_probe(domain, True, time.time() - probe_start)
+            domain['timestamp'] = domain['checked'] = time.time()
+            store.touch()
+            return 'ok'
+        record_probe(domain, False, time.time() - probe_start)
+        return 'fake' if response.status_code == 200 else 'error'
+    except Exception as e:
+        record_probe(domain, False)
+        log(f'严格检测节点{domain["domain"]}出错：{e}')
+        return 'error'
+
+
+# 严格检测最多重试5次，每次间隔递增；任一次通过返回 'ok'，否则出现过 'fake' 时返回 'fake'
+def strict_probe_retry(domain):
+    results = set()
+    for i in range(0, 5):
+        if i:
+            time.sleep(i)
+        result = strict_probe(domain)
+        if result == 'ok':
+            return result
+        results.add(result)
+    return 'fake' if 'fake' in results else 'error'
+
+
+# 自适应健康检测调度：每个节点按各自的下次检测时间放入最小堆，不再每轮全量检测
+# 稳定的节点逐步拉长检测间隔，刚上传或状态反复变化的节点保持最短间隔，回收站节点按指数退避直到 max_remove_time
+# 基础检测与严格检测共用一个调度线程，受全局每秒检测预算限制
+class ProbeScheduler:
+    def __init__(self, budget, concurrency):
+        self.cond = threading.Condition()
+        # (检测时间, 序号, 域名, 检测类型)，重新安排后旧条目留在堆中，出堆时按 due 跳过
+        self.heap = []
+        self.due = {}
+        self.running = set()
+        # 域名 -> [检测间隔, 连续成功次数, 上次检测成功的时间]
+        # 新加入节点池（上传、重启、从回收站恢复）的节点，上次成功时间记为一个最小检测间隔之前，首次检测至少续期 min_check_interval * 3
+        self.state = {}
+        # token -> 待续期秒数，由维护线程批量续期
+        self.renewals = {}
+        self.seq = 0
+        self.budget = budget
+        self.tokens = budget
+        self.refill_time = time.monotonic()
+        self.concurrency = concurrency
+        self.checked = 0
+        self.failed = 0
+        self.max_lag = 0
+        # 各阶段累计耗时：检测（按类型）与检测后的节点移动、续期
+        self.timings = collections.defaultdict(float)
+        self.thread = None
+
+    def __len__(self):
+        return len(self.due)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="Probe scheduler", daemon=True)
+            self.thread.start()
+
+    # delay 秒后检测节点，已安排了更早的检测时保持不变
+    def schedule(self, domain, kind='basic', delay=0):
+        when = time.time() + delay
+        key = (domain, kind)
+        with self.cond:
+            if key in self.due and self.due[key] <= when:
+                return
+            self.due[key] = when
+            self.seq += 1
+            heapq.heappush(self.heap, (when, self.seq, domain, kind))
+            self.cond.notify()
+
+    # 为还没有安排检测的节点补上检测（启动、其他进程上传、从日志恢复等），首次检测时间随机打散
+    def sync(self):
+        pool_nodes = registry.pool_nodes()
+        recycle_nodes = registry.recycle_nodes()
+        with self.cond:
+            known = set(self.due) | self.running
+        for node in pool_nodes:
+            if (node['domain'], 'basic') not in known:
+                self.schedule(node['domain'], 'basic', random.uniform(0, min_check_interval))
+            if (node['domain'], 'strict') not in known:
+                self.schedule(node['domain'], 'strict', random.uniform(0, strict_check_interval))
+        for node in recycle_nodes:
+            if (node['domain'], 'basic') not in known:
+                self.schedule(node['domain'], 'basic', random.uniform(0, min_check_interval))
+        domains = {node['domain'] for node in pool_nodes + recycle_nodes}
+        with self.cond:
+            for domain in [domain for domain in self.state if domain not in domains]:
+                del self.state[domain]
+
+    # 取出累计的token续期以及检测统计
+    def collect(self):
+        with self.cond:
+            renewals, self.renewals = self.renewals, {}
+            stats = {'checked': self.checked, 'failed': self.failed, 'lag': round(self.max_lag, 2),
+                     'timings': {phase: round(seconds, 3) for phase, seconds in self.timings.items()}}
+            self.checked = self.failed = self.max_lag = 0
+            self.timings.clear()
+        return renewals, stats
+
+    def _take_budget(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.budget, self.tokens + (now - self.refill_time) * self.budget)
+            self.refill_time = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.budget)
+
+    def _run(self):
+        while True:
+            try:
+                with self.cond:
+                    while True:
+                        timeout = None
+                        if self.heap and len(self.running) < self.concurrency:
+                            when, _, domain, kind = self.heap[0]
+                            if self.due.get((domain, kind)) != when:
+                                heapq.heappop(self.heap)
+                                continue
+                            timeout = when - time.time()
+                            if timeout <= 0:
+                                break
+                        self.cond.wait(timeout)
+                    heapq.heappop(self.heap)
+                    del self.due[(domain, kind)]
+                    # 由其他实例负责检测的节点不检测，保留调度以便该实例下线后接替
+                    if peer_replicator and not peer_replicator.owns(domain):
+                        self.schedule(domain, kind, min_check_interval)
+                        continue
+                    self.max_lag = max(self.max_lag, time.time() - when)
+                    self.running.add((domain, kind))
+                self._take_budget()
+                check_executor.submit(self._probe, domain, kind)
+            except Exception as e:
+                log(f'健康检测调度出错：{e}')
+
+    def _probe(self, domain, kind):
+        ok = True
+        probe_start = probe_end = time.perf_counter()
+        try:
+            node = registry.pool.get(domain) or registry.recycle.get(domain)
+            if node is None:
+                return
+            if kind == 'strict':
+                result = strict_probe_retry(node)
+                ok = result == 'ok'
+                probe_end = time.perf_counter()
+                self._after_strict(node, result)
+            else:
+                ok = is_domain_accessible(node)
+                probe_end = time.perf_counter()
+                self._after_basic(node, ok)
+        except Exception as e:
+            log(f'检测节点{domain}出错：{e}')
+        finally:
+            move_end = time.perf_counter()
+            metrics.observe('fqweb_probe_duration_seconds', probe_end - probe_start, (('kind', kind),))
+            metrics.inc('fqweb_probes_total', (('kind', kind),))
+            if not ok:
+                metrics.inc('fqweb_probe_failures_total', (('kind', kind),))
+            with self.cond:
+                self.timings[f'probe_{kind}'] += probe_end - probe_start
+                self.timings['move'] += move_end - probe_end
+                self.running.discard((domain, kind))
+                self.checked += 1
+                self.failed += not ok
+                self.cond.notify()
+
+    def _after_basic(self, node, ok):
+        domain = node['domain']
+        now = time.time()
+        with self.cond:
+            state = self.state.setdefault(domain, [min_check_interval, 0, now - min_check_interval])
+        if registry.pool.get(domain) is node:
+            if registry.is_blocked(domain):
+                registry.remove(domain, node)
+                return
+            if ok:
+                # 在线节点的token按在线时长的3倍续期
+                token = node.get('token')
+                if token and is_valid_token(token):
+                    with self.cond:
+                        self.renewals[token] = self.renewals.get(token, 0) + (now - state[2]) * 3
+                state[1] += 1
+                state[2] = now
+                if state[1] >= stable_probes:
+                    state[0] = min(state[0] * 2, max_check_interval)
+            else:
+                registry.move_to_recycle(node)
+                state[:] = [min_check_interval, 0, now]
+        elif registry.recycle.get(domain) is node:
+            if ok:
+                if registry.restore(node):
+                    wait_queue.notify()
+                state[:] = [min_check_interval, 0, now - min_check_interval]
+            else:
+                # 回收站节点指数退避，最后一次检测落在 max_remove_time 到期时
+                remaining = node['timestamp'] + max_remove_time - now
+                if remaining <= 0:
+                    registry.remove(domain, node)
+                    return
+                state[0] = max(min(state[0] * 2, remaining), min_check_interval)
+        else:
+            # 节点已被移除或重新上传
+            return
+        self.schedule(domain, 'basic', state[0])
+
+    # 只有节点对不存在的书籍也返回了内容时才封禁，请求出错的节点由基础检测移入回收站
+    def _after_strict(self, node, result):
+        domain = node['domain']
+        if registry.pool.get(domain) is not node:
+            return
+        if result == 'fake':
+            add_block_domain(domain)
+            return
+        self.schedule(domain, 'strict', strict_check_interval)
+
+
+probe_scheduler = ProbeScheduler(probe_budget, check_concurrency)
+
+
+# 上传检测队列：新上传的节点进入待检测状态，由固定数量的检测线程依次进行基础检测与严格检测，通过后加入节点池
+# 同一域名重复上传时只检测一次，队列满时拒绝上传；最近的检测结果保留一段时间供 /check 查询
+class UploadVerifier:
+    def __init__(self, max_pending, concurrency, history):
+        self.cond = threading.Condition()
+        # 域名 -> 待检测节点，按提交顺序检测
+        self.pending = collections.OrderedDict()
+        self.queue = collections.deque()
+        self.max_pending = max_pending
+        self.concurrency = concurrency
+        # 域名 -> (状态, 原因, token)，最近的检测结果（共享模式下包括其他 worker 的检测结果）
+        self.results = collections.OrderedDict()
+        # 共享模式下其他 worker 正在检测的域名 -> (token, 开始时间)
+        self.remote = {}
+        self.history = history
+        self.accepted = 0
+        self.rejected = 0
+        self.threads = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    # 提交待检测节点，返回 (提示信息, 状态码)
+    def submit(self, node):
+        with self.cond:
+            if node['domain'] in self.pending or self._remote_pending(node['domain']):
+                return '该域名正在检测中', 200
+            if len(self.pending) >= self.max_pending:
+                return '待检测的域名过多，请稍后再试', 503
+            self.pending[node['domain']] = node
+            self.queue.append(node['domain'])
+            self.results.pop(node['domain'], None)
+            self._publish(node['domain'], 'pending', None, node.get('token'))
+            if not self.threads:
+                self.threads = [threading.Thread(target=self._run, name=f"Verify upload {i}", daemon=True)
+                                for i in range(self.concurrency)]
+                for thread in self.threads:
+                    thread.start()
+            self.cond.notify()
+        return '域名已提交，检测通过后加入节点池', 200
+
+    # 返回 (状态, 原因)：pending、rejected 或 active（检测通过），没有记录时返回None
+    def status(self, domain=None, token=None):
+        with self.cond:
+            if domain in self.pending or (token and any(node.get('token') == token
+                                                        for node in self.pending.values())):
+                return 'pending', None
+            if self._remote_pending(domain) or (token and any(
+                    self._remote_pending(remote_domain) for remote_domain, (remote_token, _) in
+                    list(self.remote.items()) if remote_token == token)):
+                return 'pending', None
+            for result_domain, (state, reason, result_token) in reversed(self.results.items()):
+                if result_domain == domain or (token and result_token == token):
+                    return state, reason
+        return None
+
+    # 调用方需持有 self.cond
+    def _remote_pending(self, domain):
+        since = self.remote.get(domain, (None, None))[1]
+        if since is None:
+            return False
+        if time.time() - since < upload_pending_timeout:
+            return True
+        del self.remote[domain]
+        return False
+
+    def _remember(self, domain, state, reason, token):
+        self.results.pop(domain, None)
+        self.results[domain] = (state, reason, token)
+        while len(self.results) > self.history:
+            self.results.popitem(last=False)
+
+    # 共享模式下把检测状态写入变更日志，其他 worker 据此响应 /check 并避免重复检测
+    def _publish(self, domain, state, reason, token):
+        if store.shared:
+            store.record('verify', domain=domain, state=state, reason=reason, token=token)
+
+    # 应用其他 worker 写入的检测状态
+    def apply(self, entry):
+        with self.cond:
+            if entry['state'] == 'pending':
+                self.remote[entry['domain']] = (entry.get('token'), time.time())
+            else:
+                self.remote.pop(entry['domain'], None)
+                self._remember(entry['domain'], entry['state'], entry.get('reason'), entry.get('token'))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                node = self.pending[self.queue.popleft()]
+            try:
+                state, reason = self._verify(node)
+            except Exception as e:
+                state, reason = 'rejected', f'检测出错：{e}'
+            with self.cond:
+                del self.pending[node['domain']]
+                self._remember(node['domain'], state, reason, node.get('token'))
+                self._publish(node['domain'], state, reason, node.get('token'))
+                if state == 'active':
+                    self.accepted += 1
                 else:
-                    if 'token' in domain and domain['token']:
-                        add_or_update_token(domain['token'], (10 + delta) * 3)
+                    self.rejected += 1
+            metrics.inc('fqweb_upload_verifications_total', (('result', state),))
+
+    def _verify(self, node):
+        domain = node['domain']
+        if not is_domain_accessible(node):
+            return 'rejected', '节点无法访问'
+        # 节点对不存在的书籍也返回了内容时加入黑名单，请求出错只拒绝本次上传
+        result = strict_probe_retry(node)
+        if result == 'fake':
+            add_block_domain(domain)
+            return 'rejected', '严格检测未通过，已封禁'
+        if result != 'ok':
+            return 'rejected', '严格检测出错'
+        if registry.is_blocked(domain):
+            return 'rejected', '域名已被封禁'
+        registry.add(node)
+        store.flush()
+        wait_queue.notify()
+        if probe_scheduler.thread:
+            probe_scheduler.schedule(domain, 'basic', min_check_interval)
+            probe_scheduler.schedule(domain, 'strict', strict_check_interval)
+        if node.get('token'):
+            add_or_update_token(node['token'])
+        return 'active', None
+
+
+upload_verifier = UploadVerifier(max_pending_uploads, upload_verify_concurrency, upload_result_history)
+
+
+# 多实例同步：每条数据（节点、封禁域名、token）保存 [计数, 时间, 来源实例, 值]，计数为来源实例的单调递增序号，
+# 各实例的版本向量记录已收到的每个来源实例的最大计数。拉取时发送自己的版本向量，对方返回计数更大的数据，
+# 经过中间实例转发的数据也能传递。同一条数据的并发修改按 (时间, 来源实例) 取最新，token取较晚的过期时间
+class PeerReplicator:
+    def __init__(self, origin, peers):
+        self.lock = threading.Lock()
+        self.origin = origin
+        self.peers = peers
+        # 键 -> [计数, 时间, 来源实例, 值]，键为 node:域名、block:域名、token:token
+        self.versions = {}
+        self.vector = {origin: 0}
+        # 实例 -> 最近一次成功通信的时间
+        self.last_seen = {}
+        self.merging = threading.local()
+        self.merged = 0
+        self.session = requests.Session()
+        self.thread = None
+
+    # 启动同步线程时登记本地数据，之后的变更由 record 登记
+    def start(self):
+        if self.thread is None:
+            self.seed()
+            self.thread = threading.Thread(target=self._run, name="Peer sync", daemon=True)
+            self.thread.start()
+
+    # 计数使用毫秒时间戳保证重启后仍然递增
+    def _set(self, key, value, timestamp):
+        counter = self.vector[self.origin] = max(self.vector[self.origin] + 1, int(time.time() * 1000))
+        self.versions[key] = [counter, timestamp, self.origin, value]
+
+    # 启动时把本地已有的数据登记为最旧的版本，对方已有同一数据时以对方为准
+    def seed(self):
+        with registry.lock, token_store.lock, self.lock:
+            for node in list(registry.pool.values()) + list(registry.recycle.values()):
+                state = 'pool' if node['domain'] in registry.pool else 'recycle'
+                self._set(f"node:{node['domain']}", {'state': state, 'node': persist_node(node)}, 0)
+            for block in registry.blocks.items():
+                self._set(f"block:{block['domain']}", {'time': block['time'], 'expire': block.get('expire')}, 0)
+            for token, expire_time in token_store.expires.items():
+                self._set(f'token:{token}', expire_time, 0)
+
+    # DataStore 的变更监听：本地变更生成新版本，合并其他实例的数据时产生的变更不再登记
+    def record(self, op, fields):
+        if self.thread is None or getattr(self.merging, 'active', False):
+            return
+        now = time.time()
+        with self.lock:
+            if op == 'add':
+                self._set(f"node:{fields['node']['domain']}", {'state': 'pool', 'node': fields['node']}, now)
+            elif op in ('recycle', 'restore'):
+                node = registry.pool.get(fields['domain']) or registry.recycle.get(fields['domain'])
+                state = 'pool' if op == 'restore' else 'recycle'
+                self._set(f"node:{fields['domain']}", {'state': state, 'node': persist_node(node)}, now)
+            elif op == 'remove':
+                self._set(f"node:{fields['domain']}", {'state': 'removed'}, now)
+            elif op == 'block':
+                self._set(f"block:{fields['domain']}", {'time': fields['time'], 'expire': fields.get('expire')}, now)
+            elif op == 'unblock':
+                self._set(f"block:{fields['domain']}", None, now)
+            elif op == 'clear_blocks':
+                for key, version in list(self.versions.items()):
+                    if key.startswith('block:') and version[3] is not None:
+                        self._set(key, None, now)
+            elif op == 'token':
+                self._set(f"token:{fields['token']}", fields['expire_time'], now)
+            elif op == 'tokens':
+                for token, expire_time in fields['expires'].items():
+                    self._set(f'token:{token}', expire_time, now)
+
+    # 返回对方版本向量之后的数据
+    def delta(self, vector):
+        with self.lock:
+            entries = [[key] + version for key, version in self.versions.items()
+                       if version[0] > vector.get(version[2], 0)]
+            return entries, dict(self.vector)
+
+    # 合并其他实例的数据，返回应用的条数
+    # 等待队列的锁在注册表的锁之前获取，节点池有新节点时在释放注册表的锁之后再唤醒等待队列
+    def merge(self, entries):
+        applied = 0
+        added = False
+        self.merging.active = True
+        try:
+            with registry.lock, token_store.lock, self.lock:
+                for key, counter, timestamp, origin, value in entries:
+                    if origin == self.origin:
+                        continue
+                    self.vector[origin] = max(self.vector.get(origin, 0), counter)
+                    current = self.versions.get(key)
+                    if key.startswith('token:'):
+                        if current and current[3] >= value:
+                            continue
+                    elif current and (current[1], current[2]) >= (timestamp, origin):
+                        continue
+                    self.versions[key] = [counter, timestamp, origin, value]
+                    added = self._apply(key, value) or added
+                    applied += 1
+        finally:
+            self.merging.active = False
+        if added:
+            wait_queue.notify()
+        self.merged += applied
+        return applied
+
+    # 应用一条数据，节点加入节点池时返回True
+    @staticmethod
+    def _apply(key, value):
+        kind, name = key.split(':', 1)
+        if kind == 'token':
+            token_store.set_expires({name: value})
+            store.touch()
+        elif kind == 'block':
+            if value:
+                registry.block(name, value['time'], value.get('expire'))
+            else:
+                registry.unblock(name)
+        elif value['state'] == 'removed':
+            registry.remove(name)
+        elif registry.is_blocked(name):
+            return False
+        elif value['state'] == 'pool':
+            node = registry.recycle.get(name)
+            if node:
+                node['timestamp'] = value['node'].get('timestamp', node.get('timestamp'))
+                return registry.restore(node)
+            existing = registry.pool.get(name)
+            if existing and existing.get('token') == value['node'].get('token'):
+                return False
+            registry.remove(name)
+            return registry.add(dict(value['node'], load=0))
+        else:
+            node = registry.pool.get(name)
+            if node is None and name not in registry.recycle:
+                node = dict(value['node'], load=0)
+                registry.add(node)
+            if node is not None:
+                node['timestamp'] = value['node'].get('timestamp', node.get('timestamp'))
+                registry.move_to_recycle(node)
+        return False
 
-            # Move domains from recycle bin back to node pool if they become accessible again
-            for domain in recycle_bin:
-                if is_domain_accessible(domain):
-                    if not is_domain_exists(domain['domain']):
-                        node_pool.append(domain)
-                    recycle_bin.remove(domain)
+    def seen(self, peer):
+        self.last_seen[peer] = time.time()
 
-            # Remove domains from recycle bin if they are inaccessible for more than an hour
-            for domain in recycle_bin:
-                if time.time() - domain['timestamp'] >= max_remove_time:
-                    recycle_bin.remove(domain)
+    def alive_peers(self):
+        now = time.time()
+        return [peer for peer in self.peers if now - self.last_seen.get(peer, 0) <= peer_timeout]
+
+    # 最高随机权重哈希：在线实例中哈希值最大的实例负责检测该域名，实例上下线只影响其负责的域名
+    def owns(self, domain):
+        members = self.alive_peers()
+        if not members:
+            return True
+        members.append(self.origin)
+        return max(members, key=lambda member: hashlib.md5(f'{member}|{domain}'.encode('utf-8')).digest()) \
+            == self.origin
+
+    def sync_peer(self, peer):
+        with self.lock:
+            vector = dict(self.vector)
+        response = self.session.post(f'{peer}/peer/sync', params={'token': FQWEB_TOKEN},
+                                     json={'origin': self.origin, 'vector': vector}, timeout=peer_timeout)
+        response.raise_for_status()
+        data = response.json()
+        self.seen(peer)
+        return self.merge(data['entries'])
+
+    def _run(self):
+        while True:
+            for peer in self.peers:
+                try:
+                    applied = self.sync_peer(peer)
+                    metrics.inc('fqweb_peer_syncs_total', (('result', 'ok'),))
+                    if applied:
+                        metrics.inc('fqweb_peer_entries_total', value=applied)
+                        store.flush()
+                except Exception as e:
+                    metrics.inc('fqweb_peer_syncs_total', (('result', 'error'),))
+                    if time.time() - self.last_seen.get(peer, 0) <= peer_timeout + peer_sync_interval:
+                        log(f'同步实例{peer}出错：{e}')
+            time.sleep(peer_sync_interval)
+
+
+peer_replicator = None
+if peer_urls:
+    # 版本号只保存在一个进程中，其他 worker 无法响应 /peer/sync，多进程共享模式下不能启用
+    if shared_mode:
+        raise RuntimeError('多实例同步不支持多进程共享模式（FQWEB_SHARED=1），请以单进程运行各实例')
+    peer_replicator = PeerReplicator(self_url, [url for url in peer_urls if url != self_url])
+    store.listener = peer_replicator.record
+
+
+# 维护线程：token续期与清理、统计、持久化和定时任务，健康检测由 probe_scheduler 负责
+def manage_domains():
+    global last_sweep, shared_nodes, active_nodes
+    while True:
+        try:
+            start_check_time = time.time()
+            # 各阶段耗时，可通过 /debug/cycles 查看
+            phases = {}
+            phase_start = time.perf_counter()
+            probe_scheduler.sync()
+            phase_start = record_phase(phases, 'schedule', phase_start)
+
+            # 检测通过的节点token批量续期，续期时长相同的合并为一批
+            renewals, stats = probe_scheduler.collect()
+            batches = collections.defaultdict(list)
+            for token, seconds in renewals.items():
+                batches[round(seconds)].append(token)
+            for seconds, tokens in batches.items():
+                token_store.extend(tokens, seconds)
 
             # Remove tokens if they are invalid
-            for token in tokens:
-                if token['expire_time'] < time.time():
-                    tokens.remove(token)
+            token_store.evict_expired()
+            # 清理过期的封禁规则
+            registry.evict_expired_blocks()
+            phase_start = record_phase(phases, 'token', phase_start)
 
             # Update statistics
-            global shared_nodes, active_nodes
-            shared_nodes = len(node_pool) + len(recycle_bin)
-            active_nodes = len(node_pool)
+            shared_nodes = registry.pool_count() + registry.recycle_count()
+            active_nodes = registry.pool_count()
 
             # Save statistics to file
             save_statistics()
             # Save data to file
             save_data_to_file()
+            phase_start = record_phase(phases, 'persist', phase_start)
             # 启动定时任务
             schedule.run_pending()
+            record_phase(phases, 'jobs', phase_start)
+
+            stats['pending'] = len(probe_scheduler)
+            last_sweep = stats
+            metrics.observe('fqweb_maintenance_duration_seconds', time.time() - start_check_time)
+            cycle_timings.append({'time': fmt_time(start_check_time), 'checked': stats['checked'],
+                                  'failed': stats['failed'], 'lag': stats['lag'], 'pending': stats['pending'],
+                                  'probe_window': stats['timings'], 'maintenance': phases})
+            if stats['checked']:
+                log(f"健康检测：检测{stats['checked']}次，失败{stats['failed']}次，最大延迟{stats['lag']}秒，"
+                    f"维护耗时{round(time.time() - start_check_time, 2)}秒")
 
-            # 完成
-            delta = int(time.time() - start_check_time)
-            log(f"manage_domains执行完成，耗时：{delta}秒")
-
-            # Wait for 10 seconds before rechecking domains
             time.sleep(10)
         except Exception as e:
             log(f'manage_domains出错：{e}')
 
 
-# Start the domain management thread
-domain_manager_thread = threading.Thread(target=manage_domains, name="Check domain", daemon=True)
-domain_manager_thread.start()
+# 记录一个阶段的耗时，返回下一阶段的开始时间
+def record_phase(phases, name, start):
+    now = time.perf_counter()
+    phases[name] = round(now - start, 4)
+    return now
+
+
+# 启动健康检测线程
+def start_domain_managers():
+    if stale_nodes:
+        threading.Thread(target=verify_stale_nodes, args=(list(stale_nodes),), name="Verify stale nodes",
+                         daemon=True).start()
+    # Start the domain management thread
+    probe_scheduler.start()
+    if peer_replicator:
+        peer_replicator.start()
+    domain_manager_thread = threading.Thread(target=manage_domains, name="Check domain", daemon=True)
+    domain_manager_thread.start()
+    threading.Thread(target=record_history, name="History", daemon=True).start()
+    # 退出时保存快照，下次启动时节点的检测结果是最新的
+    atexit.register(save_on_exit)
+
+
+# 历史统计采样线程，不依赖维护线程的周期
+def record_history():
+    # 共享模式下接替采样时从其他 worker 最后保存的数据继续，共享表中的请求数从当前值开始计算增量
+    if shared_table:
+        history.reload()
+        history.last = history._counters()
+    history.sampling = True
+    save_interval = history_shared_save_interval if shared_table else history_save_interval
+    while True:
+        time.sleep(history_sample_interval)
+        try:
+            history.sample()
+            if time.time() - history.saved_time >= save_interval:
+                history.save()
+        except Exception as e:
+            log(f'记录历史统计出错：{e}')
 
 
-def is_domain_accessible_strictly(domain):
+def save_on_exit():
     try:
-        # log(f'检测节点是否有效：{domain["domain"]}')
-        url = f'http://{domain["domain"]}/content?item_id=1'
-        if 'load' not in domain:
-            domain['load'] = 0
-        domain['load'] += 1
-        response = requests.get(url)
-        domain['load'] -= 1
-        # 节点失效不需要添加黑名单
-        if response.status_code == 404:
-            return True
-        if response.status_code == 200 and '该书不存在' in response.text:
-            domain['timestamp'] = time.time()
-            return True
-        else:
-            return False
+        store.flush()
+        compact_data()
+        history.sample()
+        history.save()
     except Exception as e:
-        domain['load'] -= 1
-        log(f'严格检测节点{domain["domain"]}出错：{e}')
-        return False
+        log(f'退出时保存快照出错：{e}')
 
 
-def manage_domains_strictly():
+# 共享模式下持有 leader.lock 的进程负责健康检测、持久化和定时任务，进程退出后由其他进程接替
+leader_file = None
+is_leader = False
+
+
+# 尝试获取 leader.lock，返回本进程是否负责健康检测
+def acquire_leader():
+    global leader_file, is_leader
+    if not is_leader:
+        if leader_file is None:
+            leader_file = open(os.path.join(data_dir, 'leader.lock'), 'a')
+        try:
+            fcntl.flock(leader_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            is_leader = True
+            log(f'进程{os.getpid()}负责健康检测')
+        except BlockingIOError:
+            pass
+    return is_leader
+
+
+def sync_shared_state():
+    global shared_nodes, active_nodes
+    leader = False
     while True:
         try:
-            start_check_time = time.time()
-            for domain in node_pool:
-                flag = False
-                for i in range(0, 5):
-                    if is_domain_accessible_strictly(domain):
-                        flag = True
-                        break
-                if not flag:
-                    node_pool.remove(domain)
-                    add_block_domain(domain['domain'])
-            # 完成
-            delta = int(time.time() - start_check_time)
-            log(f"manage_domains_strictly执行完成，耗时：{delta}秒")
-
-            # Wait for 10 seconds before rechecking domains
-            time.sleep(10 * 60)
+            if not leader and acquire_leader():
+                leader = True
+                start_domain_managers()
+            shared_table.heartbeat()
+            if leader:
+                for pid, released in shared_table.reclaim():
+                    log(f'进程{pid}已退出，归还其占用的载荷{released}')
+            for entry in store.tail():
+                apply_journal_entry(entry)
+            registry.refresh_shared()
+            shared_nodes = registry.pool_count() + registry.recycle_count()
+            active_nodes = registry.pool_count()
+            # 其他进程释放的载荷不会通知本进程的等待队列，定期唤醒队首重试
+            wait_queue.notify()
         except Exception as e:
-            log(f'manage_domains_strictly出错：{e}')
+            log(f'同步共享状态出错：{e}')
+        time.sleep(shared_sync_interval)
 
 
-domain_manager_thread_strictly = threading.Thread(target=manage_domains_strictly, name="Check domain strictly",
-                                                  daemon=True)
-domain_manager_thread_strictly.start()
+def start_background_tasks():
+    load_timer.start()
+    if not shared_table:
+        start_domain_managers()
+        return
+    threading.Thread(target=sync_shared_state, name="Sync shared state", daemon=True).start()
 
 
 def fmt_time(time_):
@@ -315,25 +3059,71 @@ def fmt_time(time_):
 
 
 def add_block_domain(domain):
-    block_domains.append({'domain': domain, 'time': fmt_time(time.time())})
-    with open(os.path.join(data_dir, 'block_domains.json'), 'w') as block_domains_file:
-        json.dump(block_domains, block_domains_file)
+    block_node(domain)
+    store.flush()
+
+
+# 上传节点，返回 (提示信息, 状态码)；变更只写入日志缓冲，由调用方或维护线程写盘
+def upload_node(domain, token=None, iid=None):
+    if not domain:
+        return '未提供域名', 404
+
+    if not is_valid_domain_name(domain):
+        return '不合法的域名', 404
+
+    if registry.is_blocked(domain):
+        return '域名已被封禁', 404
+
+    if is_domain_exists(domain):
+        return '该域名已存在于节点池', 404
+
+    # 检测通过后加入节点池，同时从回收站中移除该域名（如果存在）
+    if token and is_valid_token(token):
+        node = {'domain': domain, 'token': token, 'timestamp': time.time(), 'iid': iid}
+    else:
+        node = {'domain': domain, 'timestamp': time.time()}
+    return upload_verifier.submit(node)
+
+
+# 管理员移除节点
+def remove_node(domain):
+    if not domain:
+        return '未提供域名', 404
+    if registry.remove(domain):
+        return '域名移除成功', 200
+    return '不存在的域名', 404
+
+
+# 管理员封禁域名，不立即写盘
+# domain 为封禁规则（host:port、host 或 *.suffix），expire 为有效秒数，不传时永久封禁
+def block_node(domain, expire=None):
+    if not domain:
+        return '未提供域名', 404
+    domain = domain.strip().lower()
+    if not is_valid_block_rule(domain):
+        return '不合法的规则', 404
+    try:
+        expire = time.time() + float(expire) if expire else None
+    except (TypeError, ValueError):
+        return '不合法的有效期', 404
+    registry.block(domain, expire=expire)
     log(f'黑名单添加成功：{domain}')
+    return '添加黑名单成功', 200
+
+
+def is_valid_block_rule(rule):
+    return is_valid_domain_name(rule[2:] if rule.startswith('*.') else rule)
 
 
-# Helper function to check if a domain exists in node pool or recycle bin
+# Helper function to check if a domain exists in node pool
 def is_domain_exists(domain):
-    for node in node_pool:
-        if node['domain'] == domain:
-            return True
-    return False
+    return domain in registry.view().nodes
 
 
 def is_domain_exists_by_token(token):
-    for node in node_pool:
-        if 'token' in node and node['token'] == token:
-            return True
-    return False
+    view = registry.view()
+    node = view.tokens.get(token)
+    return node is not None and node['domain'] in view.nodes
 
 
 def is_valid_token(token):
@@ -350,31 +3140,52 @@ def add_or_update_token(token, add_time=10):
     if not is_valid_token(token):
         return
     log(f'添加或更新token：{token}')
-    for token_obj in tokens:
-        if token_obj['token'] == token:
-            if token_obj['expire_time'] < time.time():
-                token_obj['expire_time'] = time.time() + add_time
-            else:
-                token_obj['expire_time'] = token_obj['expire_time'] + add_time
-            return
-    tokens.append({'token': token, 'expire_time': time.time() + add_time})
+    token_store.extend([token], add_time)
 
 
 # 在每个请求之前调用此函数，可以对响应进行处理
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+    if not started:
+        startup()
+    if trace_requests:
+        g.spans = []
+
+
 @app.after_request
 def add_headers(response):
     # 添加自定义的响应头
     response.headers['server-version-code'] = VERSION_CODE
     response.headers['server-version-name'] = VERSION_NAME
+    if 'lease_id' in g:
+        response.headers['X-Lease-Id'] = g.lease_id
+    # 按接口统计请求数与耗时，重定向接口按 allow_urls 区分
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'not_found'
+        any_url = (request.view_args or {}).get('any_url')
+        if any_url is not None:
+            route = f'/{any_url}' if any_url in allow_urls else 'other'
+        metrics.observe('fqweb_http_request_duration_seconds', time.perf_counter() - g.request_start,
+                        (('route', route),))
+        metrics.inc('fqweb_http_requests_total', (('route', route), ('status', str(response.status_code))))
+        if shared_table:
+            history.count_request(route, response.status_code)
+        # 启动后第一次成功把请求分配到节点的耗时
+        if first_redirect_time is None and route in allow_routes and response.status_code in (200, 302):
+            record_first_redirect()
+        if 'spans' in g:
+            traced_requests.append({'time': fmt_time(time.time()), 'path': request.full_path, 'route': route,
+                                    'status': response.status_code,
+                                    'duration_ms': round((time.perf_counter() - g.request_start) * 1000, 2),
+                                    'spans': g.spans})
     return response
 
 
 # 检测token是否有效
 @app.route('/valid', methods=['GET'])
 def token_valid():
-    global total_requests, daily_requests
-    total_requests += 1
-    daily_requests += 1
+    count_request()
 
     token = request.args.get('token')
     return is_token_valid(token)
@@ -385,88 +3196,42 @@ def is_token_valid(token):
     if not token:
         return '未提供token', 404
     # log(f'判断token是否有效：{token}')
-    for token_obj in tokens:
-        if token_obj['token'] == token:
-            if token_obj['expire_time'] < time.time():
-                return 'token已失效', 404
-            else:
-                return f'{fmt_time(token_obj["expire_time"])}', 200
-    return 'token不存在', 404
+    expire_time = token_store.get(token)
+    if expire_time is None:
+        return 'token不存在', 404
+    if expire_time < time.time():
+        return 'token已失效', 404
+    return f'{fmt_time(expire_time)}', 200
 
 
-# 根据token查找对应domain
-def is_token_domain(token):
-    if not token:
-        return '未提供token', 404
-    # log(f'判断token是否有效：{token}')
-    for token_obj in node_pool + recycle_bin:
-        if token_obj['token'] == token:
-            if token_obj['domain']:
-                return f'{token_obj["domain"]}', 200
-
-    return 'token不在活跃列表', 404
+# 根据token查找对应的节点（包括回收站），不存在时返回None
+def get_token_node(token):
+    node = registry.view().tokens.get(token)
+    if node and node['domain']:
+        return node
+    return None
 
 
 # 用户上传域名到节点池的接口
 @app.route('/upload', methods=['GET'])
 def upload_domain():
-    global total_requests, daily_requests
-    total_requests += 1
-    daily_requests += 1
-
-    domain = request.args.get('domain')
-    token = request.args.get('token')
-    iid = request.args.get('iid')
-    if not domain:
-        return '未提供域名', 404
-
-    if not is_valid_domain_name(domain):
-        return '不合法的域名', 404
-
-    if domain in [block['domain'] for block in block_domains]:
-        return '域名已被封禁', 404
-
-    if is_domain_exists(domain):
-        return '该域名已存在于节点池', 404
+    count_request()
 
-    # if not is_domain_accessible({'domain': domain}):
-    #    return '无效的域名', 400
-
-    # 从回收站中移除该域名（如果存在）
-    for node in recycle_bin:
-        if node['domain'] == domain:
-            recycle_bin.remove(node)
-            break
-    if token and is_valid_token(token):
-        add_or_update_token(token)
-        node_pool.append({'domain': domain, 'token': token, 'timestamp': time.time(), 'iid': iid})
-    else:
-        node_pool.append({'domain': domain, 'timestamp': time.time()})
-    return '域名已成功上传', 200
+    return upload_node(request.args.get('domain'), request.args.get('token'), request.args.get('iid'))
 
 
 # 移除指定域名
 @app.route('/remove', methods=['GET'])
 def remove_domain():
-    global total_requests, daily_requests, active_nodes, FQWEB_TOKEN
-    total_requests += 1
-    daily_requests += 1
+    global active_nodes, FQWEB_TOKEN
+    count_request()
     token = request.args.get("token")
 
     if not token:
         return '未提供token', 404
 
-    for node in node_pool + recycle_bin:
-        if 'token' in node and node['token'] == token:
-            try:
-                node_pool.remove(node)
-            except:
-                pass
-            try:
-                recycle_bin.remove(node)
-            except:
-                pass
-            return '域名移除成功', 200
+    if registry.remove_by_token(token):
+        return '域名移除成功', 200
 
     if not FQWEB_TOKEN:
         return '未设置管理员TOKEN', 404
@@ -474,31 +3239,75 @@ def remove_domain():
     if token != FQWEB_TOKEN:
         return '无效的token', 404
 
-    domain = request.args.get('domain')
-    if not domain:
-        return '未提供域名', 404
+    return remove_node(request.args.get('domain'))
 
-    for node in node_pool + recycle_bin:
-        if node['domain'] == domain:
-            try:
-                node_pool.remove(node)
-            except:
-                pass
-            try:
-                recycle_bin.remove(node)
-            except:
-                pass
-            return '域名移除成功', 200
 
-    return '不存在的域名', 404
+# 解析批量接口的请求体：JSON数组（或 {"items": [...]}），其他类型按 NDJSON 每行一项解析
+def parse_batch_items():
+    body = request.get_data(as_text=True)
+    if request.mimetype == 'application/json':
+        items = json.loads(body)
+        if isinstance(items, dict):
+            items = items.get('items')
+        if not isinstance(items, list):
+            raise ValueError('请求体不是数组')
+    else:
+        items = [json.loads(line) for line in body.splitlines() if line.strip()]
+    if len(items) > max_batch_items:
+        raise ValueError(f'单次最多{max_batch_items}项')
+    # 每一项可以是域名字符串或包含 domain 字段的对象
+    return [item if isinstance(item, dict) else {'domain': item} for item in items]
+
+
+# 逐项执行 action(item) -> (提示信息, 状态码)，最后统一写盘一次，返回每一项的结果
+def run_batch(action):
+    count_request()
+    try:
+        items = parse_batch_items()
+    except ValueError as e:
+        return f'请求体格式错误：{e}', 400
+    results = []
+    for item in items:
+        try:
+            message, status = action(item)
+        except Exception as e:
+            message, status = f'处理失败：{e}', 500
+        results.append({'domain': item.get('domain'), 'status': status, 'message': message})
+    store.flush()
+    succeeded = sum(result['status'] == 200 for result in results)
+    body = {'total': len(results), 'succeeded': succeeded, 'failed': len(results) - succeeded, 'results': results}
+    return json.dumps(body, ensure_ascii=False), 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+
+# 批量上传：[{"domain": ..., "token": ..., "iid": ...}] 或域名数组
+@app.route('/batch/upload', methods=['POST'])
+def batch_upload():
+    return run_batch(lambda item: upload_node(item.get('domain'), item.get('token'), item.get('iid')))
+
+
+# 批量移除（管理员）
+@app.route('/batch/remove', methods=['POST'])
+def batch_remove():
+    error = check_admin_token()
+    if error:
+        return error
+    return run_batch(lambda item: remove_node(item.get('domain')))
+
+
+# 批量封禁（管理员）
+@app.route('/batch/block', methods=['POST'])
+def batch_block():
+    error = check_admin_token()
+    if error:
+        return error
+    return run_batch(lambda item: block_node(item.get('domain'), item.get('expire')))
 
 
 # 重定向至随机节点池中的域名（负载均衡），重定向需要保留URL和参数进行重定向
 @app.route('/<path:any_url>', methods=['GET'])
 def redirect_to_random_domain(any_url):
-    global total_requests, daily_requests, max_load_per_node
-    total_requests += 1
-    daily_requests += 1
+    global max_load_per_node
+    count_request()
 
     # 版本不安全导致content失效，暂时改成官方api
     # if any_url == 'content':
@@ -507,115 +3316,298 @@ def redirect_to_random_domain(any_url):
 
     token = request.headers.get('token')
     tokendomain = request.headers.get('tokendomain')
-    if not node_pool:
+    # 命中缓存的请求不经过节点池
+    key = cache_key(any_url)
+    if key:
+        with span('cache'):
+            cached = response_cache.get(key)
+        if cached:
+            return Response(cached[2], cached[0], cached[1])
+
+    if not registry.view().members:
         return '没有可用的域名', 404
 
     if any_url not in allow_urls:
         return "不合法的url", 404
 
-    if is_token_valid(token)[1] == 200:
-        if is_token_domain(token)[1] == 200 and (tokendomain == "True" or tokendomain == "true"):
-            redirect_url = f"http://{is_token_domain(token)[0]}/{any_url}?{request.query_string.decode('utf-8')}"
-            return redirect(redirect_url, 302)
+    # 相同的请求正在转发时等待其结果，不再占用节点
+    flight = None
+    if key:
+        leader, flight = single_flight.join(key)
+        if not leader:
+            with span('coalesce'):
+                result = single_flight.wait(flight, coalesce_timeout)
+            if result:
+                return Response(result[2], result[0], result[1])
+            flight = None
+    response = route_to_node(any_url, token, tokendomain, key, flight)
+    # 转发成功时由响应流结束时通知等待者，没有可用节点、繁忙或节点无响应时立即让等待者各自请求
+    if flight and not isinstance(response, Response):
+        single_flight.finish(key, flight)
+    return response
+
+
+# 按token或选取策略选择节点并重定向或转发
+def route_to_node(any_url, token, tokendomain, key=None, flight=None):
+    if token_store.is_valid(token):
+        token_node = get_token_node(token) if tokendomain == "True" or tokendomain == "true" else None
+        if token_node:
+            return forward_to_node(token_node, any_url, key=key, flight=flight)
         else:
-            nodes = node_pool.copy()
-            nodes.sort(key=lambda x: x.get('load', 0))
-            domain = nodes[0]
-            redirect_url = f"http://{domain['domain']}/{any_url}?{request.query_string.decode('utf-8')}"
-            return redirect(redirect_url, 302)
-
-    # 寻找非满载的节点进行重定向，如果节点池中的节点均满载，则持续等待有非满载的节点进行重定向
-    nodes = node_pool.copy()
-    while True:
-        nodes.sort(key=lambda x: x.get('load', 0))
-        domain = nodes[0]
-        if 'load' not in domain:
-            domain['load'] = 0
-        if domain['load'] < max_load_per_node:
-            redirect_url = f"http://{domain['domain']}/{any_url}?{request.query_string.decode('utf-8')}"
-            increase_load(domain)
-            return redirect(redirect_url, 302)
-        # 若所有节点都满载，则等待0.1秒后重新检查
-        time.sleep(0.1)
+            domain = pick_node(affinity_key())
+            if not domain:
+                return '没有可用的域名', 404
+            return forward_to_node(domain, any_url, key=key, flight=flight)
+
+    # 寻找非满载的节点进行重定向，如果节点池中的节点均满载，则排队等待，队列已满或等待超时返回503
+    # 代理模式下载荷在响应结束时释放，不发放租约
+    domain = acquire_node(not proxy_mode, affinity_key())
+    if not domain:
+        return busy_response()
+    return forward_to_node(domain, any_url, acquired=True, key=key, flight=flight)
+
+
+# 重定向或代理到节点；acquired 表示已经占用了节点的载荷，key 为响应缓存的键，flight 为合并请求的等待者
+def forward_to_node(domain, any_url, acquired=False, key=None, flight=None):
+    url = f"http://{domain['domain']}/{any_url}?{request.query_string.decode('utf-8')}"
+    if not proxy_mode:
+        return redirect(url, 302)
+    # 有效token的请求不受载荷上限限制，但转发期间同样计入载荷
+    if not acquired:
+        registry.acquire(domain)
+    return proxy_to_node(domain, url, key, cache_ttls.get(any_url), flight)
+
+
+# 通过长连接转发请求并流式返回响应体，响应结束后释放载荷，并把转发结果计入节点的健康统计
+# 传入 key 时边转发边收集响应体，完整收到的200响应写入缓存，并分发给合并等待的请求
+def proxy_to_node(domain, url, key=None, ttl=None, flight=None):
+    # 转发客户端的 Accept-Encoding，响应体原样返回
+    encoding = request.headers.get('Accept-Encoding', 'identity')
+    try:
+        with span('upstream'):
+            upstream = proxy_session.get(url, headers={'Accept-Encoding': encoding}, timeout=proxy_timeout,
+                                         stream=True)
+    except Exception as e:
+        record_probe(domain, False)
+        reduce_load(domain)
+        log(f'转发请求到节点{domain["domain"]}出错：{e}')
+        return '节点无响应', 502
+    record_probe(domain, upstream.status_code < 500, upstream.elapsed.total_seconds())
+    headers = {name: upstream.headers[name] for name in proxy_headers if name in upstream.headers}
+    status = upstream.status_code
+
+    chunks = []
+    state = {'size': 0, 'complete': False}
+
+    def stream():
+        for chunk in upstream.raw.stream(proxy_chunk_size, decode_content=False):
+            if key:
+                state['size'] += len(chunk)
+                if state['size'] <= response_cache.max_entry_bytes:
+                    chunks.append(chunk)
+            yield chunk
+        state['complete'] = True
+
+    # 响应关闭时执行（客户端提前断开、响应体未开始读取时同样会执行）
+    def close():
+        upstream.close()
+        reduce_load(domain)
+        result = None
+        if key and state['complete'] and state['size'] <= response_cache.max_entry_bytes:
+            body = b''.join(chunks)
+            if status < 500:
+                result = (status, headers, body)
+            if status == 200 and is_cacheable_body(headers.get('Content-Encoding'), body):
+                response_cache.put(key, ttl, status, headers, body)
+        if flight:
+            single_flight.finish(key, flight, result)
+
+    response = Response(stream(), status, headers)
+    response.call_on_close(close)
+    return response
+
+
+# 响应缓存与请求合并的键：接口路径 + 排序后的参数 + Accept-Encoding，不缓存的请求返回None
+def cache_key(any_url):
+    if not proxy_mode or any_url not in cache_ttls:
+        return None
+    if any_url == 'content' and not request.args.get('item_id'):
+        return None
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return f"{any_url}?{query}|{request.headers.get('Accept-Encoding', 'identity')}"
+
+
+# 节点返回的“该书不存在”等错误信息不缓存
+def is_cacheable_body(encoding, body):
+    try:
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        elif encoding not in (None, 'identity'):
+            return False
+    except zlib.error:
+        return False
+    return '该书不存在'.encode('utf-8') not in body
 
 
 # 用户随机获取节点池中的域名（负载均衡）
 @app.route('/random', methods=['GET'])
 def get_random_domain():
-    global total_requests, daily_requests
-    total_requests += 1
-    daily_requests += 1
+    count_request()
 
     token = request.headers.get('token')
     tokendomain = request.headers.get('tokendomain')
-    if not node_pool:
+    if not registry.view().members:
         return '没有可用的域名', 404
 
-    if is_token_valid(token)[1] == 200:
-        if is_token_domain(token)[1] == 200 and (tokendomain == "True" or tokendomain == "true"):
-            return f"http://{is_token_domain(token)[0]}", 200
+    if token_store.is_valid(token):
+        token_node = get_token_node(token) if tokendomain == "True" or tokendomain == "true" else None
+        if token_node:
+            return f"http://{token_node['domain']}", 200
         else:
-            nodes = node_pool.copy()
-            nodes.sort(key=lambda x: x.get('load', 0))
-            domain = nodes[0]
+            domain = pick_node(affinity_key())
+            if not domain:
+                return '没有可用的域名', 404
             increase_load(domain)
             return f"http://{domain['domain']}", 200
 
-    # 寻找非满载的节点进行选取，如果节点池中的节点均满载，则持续等待有非满载的节点进行选取
-    nodes = node_pool.copy()
-    while True:
-        nodes.sort(key=lambda x: x.get('load', 0))
-        domain = nodes[0]
-        if 'load' not in domain:
-            domain['load'] = 0
-        if domain['load'] < max_load_per_node:
-            increase_load(domain)
-            return f"http://{domain['domain']}", 200
-        # 若所有节点都满载，则等待0.1秒后重新检查
-        time.sleep(0.1)
+    # 寻找非满载的节点进行选取，如果节点池中的节点均满载，则排队等待，队列已满或等待超时返回503
+    domain = acquire_node(key=affinity_key())
+    if not domain:
+        return busy_response()
+    return f"http://{domain['domain']}", 200
+
+
+# 选取载荷最低且未满载的节点并占用一个载荷，所有节点都满载时进入等待队列，排队失败或超时返回None
+# lease 为 False 时由调用方负责释放载荷，否则发放租约，key 为内容亲和路由的键
+def acquire_node(lease=True, key=None):
+    wait_start = time.perf_counter()
+    with span('acquire'):
+        domain = wait_queue.acquire(lambda: try_acquire_node(key))
+    metrics.observe('fqweb_wait_duration_seconds', time.perf_counter() - wait_start)
+    if domain:
+        metrics.inc('fqweb_node_selections_total', (('node', domain['domain']),))
+        if lease:
+            lease_node(domain)
+    return domain
+
+
+# 按选取策略占用一个未满载的节点，全部满载时返回None
+def try_acquire_node(key=None):
+    if key is not None:
+        return registry.acquire_affinity(key, max_load_per_node)
+    if selection_policy == 'least_load':
+        return registry.acquire_least_loaded(max_load_per_node)
+    return registry.acquire_two_choices(node_cost, max_load_per_node)
+
+
+# 按选取策略选择节点，不检查是否满载（有效token的请求不受载荷限制）
+def pick_node(key=None):
+    with span('pick'):
+        if key is not None:
+            domain = registry.affinity(key, max_load_per_node)
+        elif selection_policy == 'least_load':
+            domain = registry.least_loaded()
+        else:
+            domain = registry.two_choices(node_cost)
+    if domain:
+        metrics.inc('fqweb_node_selections_total', (('node', domain['domain']),))
+    return domain
+
+
+# 内容亲和路由的键：同一本书的请求使用 book_id，没有时使用 item_id；未启用亲和路由时返回None
+def affinity_key():
+    if selection_policy != 'affinity':
+        return None
+    return request.args.get('book_id') or request.args.get('item_id')
+
+
+def busy_response():
+    return '节点繁忙，请稍后重试', 503, {'Retry-After': str(int(process_time))}
 
 
 def increase_load(domain):
-    global process_time
-    domain['load'] += 1
-    # delay_time秒后将载荷减1
-    threading.Timer(process_time, lambda: reduce_load(domain)).start()
+    registry.acquire(domain)
+    lease_node(domain)
     # log(f'节点载荷加一：{domain}')
 
 
+# 为本次请求占用的载荷发放租约，租约id通过 X-Lease-Id 响应头返回
+def lease_node(domain):
+    g.lease_id = lease_table.issue(domain)
+
+
 def reduce_load(domain):
-    domain['load'] -= 1
+    registry.release(domain)
+    wait_queue.notify()
     # log(f'节点载荷减一：{domain}')
 
 
+# 释放租约：客户端（或节点）用完分配的节点后调用，租约id来自 X-Lease-Id 响应头
+@app.route('/release', methods=['GET', 'POST'])
+def release_lease():
+    lease_id = request.args.get('lease') or request.headers.get('X-Lease-Id')
+    if not lease_id:
+        return '未提供租约', 404
+    if not lease_table.end(lease_id):
+        return '租约不存在或已过期', 404
+    return '租约已释放', 200
+
+
 # 获取所有活跃节点的域名，换行输出
 @app.route('/status', methods=['GET'])
 def get_active_nodes():
-    global total_requests, daily_requests, active_nodes, FQWEB_TOKEN
-    total_requests += 1
-    daily_requests += 1
+    global active_nodes, FQWEB_TOKEN
+    count_request()
     token = request.args.get("token")
     if not FQWEB_TOKEN:
         return '未设置管理员TOKEN', 404
     if not token or token != FQWEB_TOKEN:
         return '无效的token', 404
-    if not node_pool:
+    view = registry.view()
+    if not view.members:
         return '没有可用的节点', 404
 
-    active_node_domains = '\n'.join(f'{domain["domain"]}: {domain.get("load", 0)}' for domain in node_pool)
-    return active_node_domains, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    # 不分页时整个响应体按快照版本缓存
+    if 'offset' not in request.args and 'limit' not in request.args:
+        body = body_cache.get('status', view.version,
+                              lambda: '\n'.join(format_status_line(node) for node in view.nodes.values()))
+        return body, 200, {'Content-Type': 'text/plain; charset=utf-8', 'X-Total-Count': str(len(view.members))}
+    return stream_lines(list(view.nodes.values()), format_status_line)
+
+
+def format_status_line(domain):
+    return (f'{domain["domain"]}: {domain.get("load", 0)} {int(domain.get("rtt", 0) * 1000)}ms '
+            f'{int(domain.get("success", 1.0) * 100)}%')
+
+
+# 分页并流式输出列表：offset 为起始位置，limit 为最多输出的行数（默认全部），总数放在 X-Total-Count 响应头中
+def stream_lines(items, format_line):
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = request.args.get('limit', type=int)
+    page = itertools.islice(items, offset, None if limit is None else offset + max(limit, 0))
+
+    def generate():
+        first = True
+        while True:
+            chunk = [format_line(item) for item in itertools.islice(page, stream_chunk_lines)]
+            if not chunk:
+                return
+            yield ('' if first else '\n') + '\n'.join(chunk)
+            first = False
+
+    return Response(generate(), 200, {'Content-Type': 'text/plain; charset=utf-8', 'X-Total-Count': str(len(items))})
 
 
 @app.route('/check', methods=['GET'])
 def check_domain():
-    global total_requests, daily_requests
-    total_requests += 1
-    daily_requests += 1
+    count_request()
 
     domain = request.args.get('domain')
     token = request.args.get('token')
     if domain:
-        if domain in block_domains:
+        if registry.view().blocks.match(domain):
             return '节点已被封禁', 200
 
         if is_domain_exists(domain):
@@ -625,83 +3617,281 @@ def check_domain():
         if is_domain_exists_by_token(token):
             return '节点状态：在线', 200
 
+    # 刚上传的节点：检测中或检测未通过
+    if domain or token:
+        verify_status = upload_verifier.status(domain, token)
+        if verify_status and verify_status[0] == 'pending':
+            return '节点状态：检测中', 200
+        if verify_status and verify_status[0] == 'rejected':
+            return f'节点状态：检测未通过（{verify_status[1]}）', 200
+
     return '节点不存在或者已离线', 200
 
 
 # 获取可用节点数
 @app.route('/available', methods=['GET'])
 def get_active_nodes_num():
-    return f'{active_nodes}', 200
+    return f'{len(registry.view().members)}', 200
 
 
 # 获取统计数据的接口
 @app.route('/stats', methods=['GET'])
 def get_statistics():
-    global total_requests, daily_requests, shared_nodes, active_nodes, start_time, max_load_per_node
+    stats_text = body_cache.get('stats', registry.version, build_statistics)
+    return stats_text, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
+def build_statistics():
+    global shared_nodes, active_nodes, start_time, max_load_per_node
+    total, daily, yesterday = request_counts()
     uptime_hours = round((time.time() - start_time) / 3600, 2)
+    wait_p50, wait_p90, wait_p99 = wait_queue.percentiles(0.5, 0.9, 0.99)
+    # 还没有成功分配过节点时显示 -
+    first_redirect = '-' if first_redirect_time is None else first_redirect_time
+    peer_text = ''
+    if peer_replicator:
+        peer_text = (f"多实例同步：在线实例{len(peer_replicator.alive_peers())}/{len(peer_replicator.peers)}，"
+                     f"合并{peer_replicator.merged}条\n")
     stats_text = (
-        f"总请求次数：{total_requests}\n"
-        f"日请求次数：{daily_requests}\n"
-        f"昨日请求数：{yesterday_requests}\n"
+        f"总请求次数：{total}\n"
+        f"日请求次数：{daily}\n"
+        f"昨日请求数：{yesterday}\n"
         f"共享节点数：{shared_nodes}\n"
         f"活跃节点数：{active_nodes}\n"
         f"请求队列数：{get_all_loads()}/{active_nodes * max_load_per_node}\n"
+        f"排队请求数：{len(wait_queue)}/{wait_queue.max_length}（拒绝{wait_queue.rejected}，超时{wait_queue.timeouts}）\n"
+        f"排队耗时(秒)：p50={wait_p50} p90={wait_p90} p99={wait_p99}\n"
+        f"健康检测：近10秒检测{last_sweep['checked']}次，失败{last_sweep['failed']}次，"
+        f"最大延迟{last_sweep['lag']}秒，待检测{last_sweep['pending']}项\n"
+        f"响应缓存：命中{response_cache.hits}，未命中{response_cache.misses}，淘汰{response_cache.evictions}，"
+        f"{len(response_cache)}项共{round(response_cache.size / 1024 / 1024, 2)}MB\n"
+        f"请求合并：合并{single_flight.coalesced}次，合并率{single_flight.rate()}%，超时回退{single_flight.fallbacks}次\n"
+        f"租约：持有{len(lease_table)}，主动释放{lease_table.released}，过期{lease_table.expired}，"
+        f"平均占用{lease_table.mean_hold_time()}秒\n"
+        f"上传检测：待检测{len(upload_verifier)}，通过{upload_verifier.accepted}，未通过{upload_verifier.rejected}\n"
+        f"{peer_text}"
+        f"启动耗时(秒)：加载数据{load_time}，首次成功分配节点{first_redirect}\n"
         f"运行时间(小时)：{uptime_hours}\n"
         f"当前服务版本：{VERSION_NAME}"
     )
-    return stats_text, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    return stats_text
+
+
+# 历史统计：resolution 为 minute（默认）或 hour，since 为开始时间（Unix时间戳，秒）
+@app.route('/stats/history', methods=['GET'])
+def get_history():
+    resolution = request.args.get('resolution', 'minute')
+    if resolution not in history.series:
+        return '不支持的resolution', 400
+    since = request.args.get('since', 0, type=float)
+    samples = history.query(resolution, since)
+    body = {
+        'resolution': resolution,
+        'period': history.series[resolution].period,
+        'columns': ['time'] + history.columns,
+        'samples': [[int(when)] + [int(value) if value.is_integer() else round(value, 3) for value in values]
+                    for when, values in samples],
+    }
+    return json.dumps(body, ensure_ascii=False, separators=(',', ':')), 200, \
+        {'Content-Type': 'application/json; charset=utf-8'}
+
+
+# Prometheus 格式的指标；共享模式下计数类指标为当前 worker 的数据，节点载荷与检测结果为所有 worker 共享的数据
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    nodes = registry.pool_nodes()
+    gauges = [
+        ('fqweb_nodes', (('state', 'active'),), len(nodes)),
+        ('fqweb_nodes', (('state', 'recycle'),), registry.recycle_count()),
+        ('fqweb_load_total', (), get_all_loads()),
+        ('fqweb_load_capacity', (), len(nodes) * max_load_per_node),
+        ('fqweb_probe_pending', (), len(probe_scheduler)),
+        ('fqweb_probe_lag_seconds', (), last_sweep['lag']),
+        ('fqweb_wait_queue_length', (), len(wait_queue)),
+        ('fqweb_wait_rejected_total', (), wait_queue.rejected),
+        ('fqweb_wait_timeouts_total', (), wait_queue.timeouts),
+        ('fqweb_cache_requests_total', (('result', 'hit'),), response_cache.hits),
+        ('fqweb_cache_requests_total', (('result', 'miss'),), response_cache.misses),
+        ('fqweb_cache_evictions_total', (), response_cache.evictions),
+        ('fqweb_cache_bytes', (), response_cache.size),
+        ('fqweb_coalesced_total', (), single_flight.coalesced),
+    ]
+    gauges.append(('fqweb_pending_uploads', (), len(upload_verifier)))
+    gauges.append(('fqweb_leases_active', (), len(lease_table)))
+    if peer_replicator:
+        gauges.append(('fqweb_peers_alive', (), len(peer_replicator.alive_peers())))
+    if load_time is not None:
+        gauges.append(('fqweb_startup_load_seconds', (), load_time))
+    if first_redirect_time is not None:
+        gauges.append(('fqweb_first_redirect_seconds', (), first_redirect_time))
+    for node in nodes:
+        labels = (('node', node['domain']),)
+        gauges.append(('fqweb_node_load', labels, node.get('load', 0)))
+        if 'rtt' in node:
+            gauges.append(('fqweb_node_rtt_seconds', labels, node['rtt']))
+            gauges.append(('fqweb_node_success_ratio', labels, node.get('success', 1.0)))
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+# 管理员token校验，通过时返回None
+def check_admin_token():
+    token = request.args.get("token")
+    if not FQWEB_TOKEN:
+        return '未设置管理员TOKEN', 404
+    if not token or token != FQWEB_TOKEN:
+        return '无效的token', 404
+    return None
+
+
+# 开始采样分析，seconds 秒后自动停止
+@app.route('/debug/profile/start', methods=['GET'])
+def start_profile():
+    error = check_admin_token()
+    if error:
+        return error
+    try:
+        seconds = min(float(request.args.get('seconds', 30)), max_profile_seconds)
+        interval = max(float(request.args.get('interval', 0.01)), 0.001)
+    except ValueError:
+        return '参数错误', 400
+    if not profiler.start(seconds, interval):
+        return '采样分析正在进行', 409
+    return f'开始采样分析，持续{seconds}秒', 200
+
+
+@app.route('/debug/profile/stop', methods=['GET'])
+def stop_profile():
+    error = check_admin_token()
+    if error:
+        return error
+    profiler.stop()
+    return f'采样分析已停止，共采样{profiler.samples}次', 200
+
+
+# 下载最近一次采样分析的结果（进行中时为当前已采集的部分）
+@app.route('/debug/profile', methods=['GET'])
+def download_profile():
+    error = check_admin_token()
+    if error:
+        return error
+    if profiler.started is None:
+        return '没有采样分析结果', 404
+    filename = time.strftime('profile-%Y%m%d-%H%M%S.folded', time.localtime(profiler.started))
+    return profiler.dump(), 200, {'Content-Type': 'text/plain; charset=utf-8',
+                                  'Content-Disposition': f'attachment; filename={filename}',
+                                  'X-Profile-Samples': str(profiler.samples),
+                                  'X-Profile-Running': str(profiler.running()).lower()}
+
+
+# 开启或关闭请求耗时分段记录：enable=1 开启，enable=0 关闭
+@app.route('/debug/trace', methods=['GET'])
+def toggle_trace():
+    global trace_requests
+    error = check_admin_token()
+    if error:
+        return error
+    trace_requests = request.args.get('enable', '1') == '1'
+    if not trace_requests:
+        traced_requests.clear()
+    return f"请求追踪已{'开启' if trace_requests else '关闭'}", 200
+
+
+# 最近记录的请求中耗时最长的 limit 个及其各阶段耗时
+@app.route('/debug/slow', methods=['GET'])
+def get_slow_requests():
+    error = check_admin_token()
+    if error:
+        return error
+    limit = request.args.get('limit', 20, type=int)
+    slowest = heapq.nlargest(limit, list(traced_requests), key=lambda item: item['duration_ms'])
+    return json.dumps(slowest, ensure_ascii=False, indent=2), 200, {'Content-Type': 'application/json'}
+
+
+# 最近的维护周期各阶段耗时：probe_window 为该周期内健康检测（按类型）与节点移动的累计耗时
+@app.route('/debug/cycles', methods=['GET'])
+def get_cycle_timings():
+    error = check_admin_token()
+    if error:
+        return error
+    return json.dumps(list(cycle_timings), ensure_ascii=False, indent=2), 200, {'Content-Type': 'application/json'}
 
 
 @app.route('/block', methods=['GET'])
 def block_domain():
-    global total_requests, daily_requests, active_nodes, FQWEB_TOKEN
-    total_requests += 1
-    daily_requests += 1
+    global active_nodes, FQWEB_TOKEN
+    count_request()
     token = request.args.get("token")
     if not FQWEB_TOKEN:
         return '未设置管理员TOKEN', 404
     if not token or token != FQWEB_TOKEN:
         return '无效的token', 404
-    domain = request.args.get('domain')
-    if not domain:
+    message, status = block_node(request.args.get('domain'), request.args.get('expire'))
+    if status == 200:
+        store.flush()
+    return message, status
+
+
+# 删除一条封禁规则（管理员）
+@app.route('/unblock', methods=['GET'])
+def unblock_domain():
+    error = check_admin_token()
+    if error:
+        return error
+    rule = (request.args.get('domain') or '').strip().lower()
+    if not rule:
         return '未提供域名', 404
-
-    add_block_domain(domain)
-
-    return '添加黑名单成功', 200
+    if not registry.unblock(rule):
+        return '不存在的规则', 404
+    store.flush()
+    return '已解除封禁', 200
 
 
 @app.route('/clear/blocks', methods=['GET'])
 def clear_block_domains():
-    global total_requests, daily_requests, active_nodes, FQWEB_TOKEN
-    total_requests += 1
-    daily_requests += 1
+    global active_nodes, FQWEB_TOKEN
+    count_request()
     token = request.args.get("token")
     if not FQWEB_TOKEN:
         return '未设置管理员TOKEN', 404
     if not token or token != FQWEB_TOKEN:
         return '无效的token', 404
 
-    block_domains.clear()
-    with open(os.path.join(data_dir, 'block_domains.json'), 'w') as block_domains_file:
-        json.dump(block_domains, block_domains_file)
+    registry.clear_blocks()
+    store.flush()
 
     return '黑名单清理成功', 200
 
 
 @app.route('/get/blocks', methods=['GET'])
 def get_block_domains():
-    global total_requests, daily_requests, active_nodes, FQWEB_TOKEN
-    total_requests += 1
-    daily_requests += 1
+    global active_nodes, FQWEB_TOKEN
+    count_request()
     token = request.args.get("token")
     if not FQWEB_TOKEN:
         return '未设置管理员TOKEN', 404
     if not token or token != FQWEB_TOKEN:
         return '无效的token', 404
+    block_domains = registry.blocked()
     if not block_domains:
         return '没有封禁的域名', 404
-    return '\n'.join([str(domain) for domain in block_domains]), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    return stream_lines(block_domains, str)
+
+
+# 多实例同步：返回请求方版本向量之后的数据
+@app.route('/peer/sync', methods=['POST'])
+def peer_sync():
+    error = check_admin_token()
+    if error:
+        return error
+    if not peer_replicator or peer_replicator.thread is None:
+        return '未启用多实例同步', 503
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('vector'), dict):
+        return '请求格式错误', 400
+    if data.get('origin') in peer_replicator.peers:
+        peer_replicator.seen(data['origin'])
+    entries, vector = peer_replicator.delta(data['vector'])
+    return {'origin': peer_replicator.origin, 'vector': vector, 'entries': entries}
 
 
 @app.route('/', methods=['GET'])
@@ -710,14 +3900,53 @@ def main_page():
 
 
 def get_all_loads():
-    loads = 0
-    for domain in node_pool:
-        if 'load' in domain:
-            loads += domain['load']
-    return loads
+    return registry.total_load()
+
+
+# 启动时间统计：加载数据耗时，以及从进程启动到第一次成功重定向（或转发、/random）的耗时
+startup_lock = threading.Lock()
+started = False
+load_time = None
+first_redirect_time = None
+allow_routes = {'/random'} | {f'/{url}' for url in allow_urls}
+
+
+def record_first_redirect():
+    global first_redirect_time
+    with startup_lock:
+        if first_redirect_time is None:
+            first_redirect_time = round(time.time() - process_start, 3)
+            log(f'启动后首次成功分配节点，耗时{first_redirect_time}秒')
+
+
+def load_version_name():
+    global COMMIT_ID, VERSION_NAME
+    COMMIT_ID = get_latest_commit_id()
+    VERSION_NAME = "v" + ".".join(str(VERSION_CODE)) + COMMIT_ID
+
+
+# 启动：打开共享表、加载统计数据与快照、启动后台线程并查询版本号。导入模块时不执行，
+# 由 __main__、gunicorn 的 post_worker_init 调用，其他方式部署时在第一个请求前执行
+def startup():
+    global started, load_time
+    with startup_lock:
+        if started:
+            return
+        started = True
+        load_start = time.time()
+        if shared_mode:
+            open_shared_table()
+        load_statistics()
+        history.load()
+        load_data_from_file()
+        load_time = round(time.time() - load_start, 3)
+        start_background_tasks()
+        threading.Thread(target=load_version_name, name="Version", daemon=True).start()
+        log(f'启动完成，加载数据耗时{load_time}秒')
 
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         FQWEB_TOKEN = sys.argv[1]
-    app.run(host='0.0.0.0', port=9998)
+    startup()
+    app.run(host='0.0.0.0', port=int(os.environ.get("FQWEB_PORT", 9998)))